@@ -1,9 +1,14 @@
 import sys
-from asyncio import Queue
+from asyncio import Event, PriorityQueue, Queue, QueueFull, QueueShutDown
+from collections.abc import AsyncIterator, Callable, Iterator
+from itertools import count
+from time import monotonic
+from typing import Protocol
 
-from aiohttp import ClientConnectionResetError
 from loguru import logger
 
+from cliptalk import config, wav
+
 __version__ = '2025.09.19'
 
 # Remove the default handler to prevent duplicate output if you're reconfiguring
@@ -19,38 +24,267 @@ logger.add(
 
 
 class SizeUpdatingQ[T](Queue):
-    def __init__(self, action: str, current_ws_container, maxsize=0):
-        self.action = action
+    """A queue that reports its size with `publish(name, 'size/maxsize')`."""
+
+    def __init__(
+        self,
+        name: str,
+        publish: Callable[[str, str], None],
+        maxsize=0,
+    ):
+        self.name = name
         super().__init__(maxsize)
-        self.current_ws_container = current_ws_container
+        self.publish = publish
+        self.peak = 0
+
+    # put and get call these, too
+    def put_nowait(self, item: T):
+        super().put_nowait(item)
+        self.peak = max(self.peak, self.qsize())
+        self.update_status()
+
+    def get_nowait(self) -> T:
+        item = super().get_nowait()
+        self.update_status()
+        return item
+
+    def update_status(self):
+        self.publish(self.name, f'{self.qsize()}/{self.maxsize}')
+
+    def put_all_nowait(self, items: list[T]):
+        """Put all of `items` or, if they do not fit, raise QueueFull."""
+        if self.maxsize > 0 and self.qsize() + len(items) > self.maxsize:
+            raise QueueFull
+        for item in items:
+            self.put_nowait(item)
+
+
+class PrioritySizeUpdatingQ[T](SizeUpdatingQ[T], PriorityQueue):
+    pass
+
+
+_text_order = count()
+
+
+class Text:
+    """A text waiting for synthesis, with optional routing hints."""
+
+    def __init__(
+        self,
+        trace_id: str,
+        text: str,
+        lang: str | None = None,
+        engine: str | None = None,
+        priority: int = 0,
+    ):
+        self.trace_id = trace_id
+        self.text = text
+        self.lang = lang
+        self.engine = engine
+        self.priority = priority
+        self._order = next(_text_order)
+
+    def __lt__(self, other: 'Text') -> bool:
+        # higher priority first, then first come first served
+        return (-self.priority, self._order) < (-other.priority, other._order)
+
+
+class ByteBudget:
+    """
+    Limit the bytes held by all AudioBuffers together.
+
+    Puts wait while the budget is exceeded, which pauses the engines that
+    fill them. Bytes are released when a buffer is discarded.
+    """
+
+    def __init__(self, limit: int):
+        # 0 means unlimited
+        self.limit = limit
+        self.used = 0
+        self._changed = Event()
+
+    def notify(self):
+        self._changed.set()
+        self._changed = Event()
+
+    def exceeded(self) -> bool:
+        return 0 < self.limit < self.used
+
+    async def wait(self):
+        await self._changed.wait()
+
+    def release(self, size: int):
+        self.used -= size
+        self.notify()
+
+
+audio_budget = ByteBudget(config.AUDIO_BUDGET)
+
+
+class AudioBuffer:
+    """
+    Replayable audio of a single item.
+
+    Engines put chunks into it as they would into an AudioQ. Small chunks are
+    coalesced into blocks of up to AUDIO_BLOCK_SIZE bytes; the last block
+    may still be growing. Readers iterate the blocks from the start, each at
+    their own pace, while synthesis is still in progress.
+    """
+
+    def __init__(self):
+        # bytes, and a bytearray for the last block while it is growing
+        self.chunks: list[bytes | bytearray] = []
+        self.size = 0
+        self.done = False
+        self.cancelled = False
+        # the item that is playing must never wait for the budget
+        self.exempt = False
+        # monotonic time of the first put, for latency metrics
+        self.first_chunk_time: float | None = None
+        self._changed = Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = Event()
+
+    def exempt_from_budget(self):
+        self.exempt = True
+        audio_budget.notify()
+
+    async def wait_for_budget(self):
+        """
+        Wait while AUDIO_BUDGET is exceeded, unless this item is playing.
+
+        Renders call this before they take an engine slot, so that an item
+        that waits never holds up the engines of the playing one.
+        """
+        while audio_budget.exceeded() and not (self.exempt or self.done):
+            await audio_budget.wait()
+        if self.done:
+            raise QueueShutDown
+
+    async def put(self, data: bytes):
+        if self.done:
+            raise QueueShutDown
+        if not data:
+            return
+        chunks = self.chunks
+        if not chunks:
+            self.first_chunk_time = monotonic()
+        if (
+            chunks
+            and type(last := chunks[-1]) is bytearray
+            and len(last) + len(data) <= config.AUDIO_BLOCK_SIZE
+        ):
+            last += data
+        else:
+            self._seal()
+            chunks.append(
+                bytearray(data)
+                if len(data) < config.AUDIO_BLOCK_SIZE
+                else bytes(data)
+            )
+        self.size += len(data)
+        audio_budget.used += len(data)
+        self._notify()
+
+    def _seal(self):
+        chunks = self.chunks
+        if chunks and type(chunks[-1]) is bytearray:
+            chunks[-1] = bytes(chunks[-1])
+
+    def shutdown(self, immediate: bool = False):
+        """Mark the audio as complete, or discard it if `immediate`."""
+        if self.done and not immediate:
+            return
+        self.done = True
+        if immediate:
+            if not self.cancelled:
+                audio_budget.release(self.size)
+            self.cancelled = True
+            self.chunks.clear()
+            self.size = 0
+        else:
+            self._seal()
+            self._set_wav_size()
+        self._notify()
+
+    def _set_wav_size(self):
+        # WAV engines stream a header with placeholder sizes; now that the
+        # length is known, later readers get a correct one.
+        chunks = self.chunks
+        if not chunks or not (header_size := wav.header_size(chunks[0])):
+            return
+        chunks[0] = (
+            wav.with_data_size(
+                chunks[0][:header_size], self.size - header_size
+            )
+            + chunks[0][header_size:]
+        )
+
+    @property
+    def content_type(self) -> str:
+        chunks = self.chunks
+        if chunks and chunks[0][:4] == b'RIFF':
+            return 'audio/wav'
+        return 'audio/mpeg'
+
+    async def wait_for_data(self):
+        """Wait until the first chunk is available or the audio is done."""
+        while not (self.chunks or self.done):
+            await self._changed.wait()
+
+    async def wait_done(self):
+        while not self.done:
+            await self._changed.wait()
+
+    async def wait_for_size(self, size: int):
+        """Wait until `size` bytes are available or the audio is done."""
+        while self.size < size and not self.done:
+            await self._changed.wait()
+
+    def slices(self, start: int, stop: int) -> Iterator[memoryview]:
+        """Yield the bytes in [start, stop) without joining the chunks."""
+        offset = 0
+        for chunk in self.chunks:
+            end = offset + len(chunk)
+            if end > start:
+                yield memoryview(chunk)[
+                    max(start - offset, 0) : min(stop, end) - offset
+                ]
+            if end >= stop:
+                return
+            offset = end
 
-    async def put(self, item: T):
-        await super().put(item)
-        await self.update_front_end_status()
+    async def read(self) -> AsyncIterator[bytes]:
+        """Yield everything that is available, a block at a time."""
+        i = offset = 0
+        chunks = self.chunks
+        while not self.cancelled:
+            if i < len(chunks):
+                chunk = chunks[i]
+                if offset < len(chunk):
+                    # a copy, the growing block may not be exported
+                    yield chunk[offset:] if offset else bytes(chunk)
+                    offset = len(chunk)
+                    continue
+                if i + 1 < len(chunks) or type(chunk) is bytes:
+                    i += 1
+                    offset = 0
+                    continue
+            if self.done:
+                return
+            await self._changed.wait()
 
-    async def update_front_end_status(self):
-        current_ws = self.current_ws_container.get('current_ws')
-        if current_ws is not None:
-            try:
-                await current_ws.send_json(
-                    {
-                        'action': self.action,
-                        'value': f'{self.qsize()}/{self.maxsize}',
-                    }
-                )
-            except ClientConnectionResetError:
-                logger.warning('Could not update front-end status')
 
-    def task_done(self):
-        raise NotImplementedError('use `atask_done` instead')
+class AudioSink(Protocol):
+    """What engines put audio into: an AudioQ, an AudioBuffer or a wrapper."""
 
-    async def atask_done(self):
-        super().task_done()
-        await self.update_front_end_status()
+    async def put(self, data: bytes, /) -> None: ...
 
 
 AudioQ = Queue[bytes]
-# Queue to store incoming clipboard texts
-InputQ = SizeUpdatingQ[str]
-# Queue to store pre-generated audio data
-OutputQ = SizeUpdatingQ[tuple[str, bool, AudioQ]]
+# Queue to store incoming texts, highest priority first
+InputQ = PrioritySizeUpdatingQ[Text]
+# Queue to store pre-generated audio data as (trace_id, text, is_fa, audio)
+OutputQ = SizeUpdatingQ[tuple[str, str, bool, AudioBuffer]]
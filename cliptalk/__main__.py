@@ -1,105 +1,334 @@
 __version__ = '0.1.dev0'
 
+import json
 import sys
 import webbrowser
-from asyncio import Event, QueueShutDown, new_event_loop, sleep, to_thread
-from collections.abc import Awaitable, Callable
-from multiprocessing import Pipe, Process
+from asyncio import (
+    IncompleteReadError,
+    QueueFull,
+    QueueShutDown,
+    Semaphore,
+    StreamReader,
+    StreamWriter,
+    Task,
+    create_task,
+    new_event_loop,
+    sleep,
+    start_server,
+)
+from collections.abc import Awaitable, Callable, Collection
+from contextlib import aclosing
+from functools import partial
+from hmac import compare_digest
+from itertools import count
+from multiprocessing import Process
 from pathlib import Path
+from secrets import token_bytes
+from time import monotonic, time
 
 from aiohttp.web import (
     Application,
+    HTTPBadRequest,
+    HTTPNotFound,
+    HTTPRequestEntityTooLarge,
+    HTTPRequestRangeNotSatisfiable,
     Request,
     Response,
     RouteTableDef,
     StreamResponse,
     WebSocketResponse,
+    json_response,
     run_app,
 )
 
-from cliptalk import AudioQ, InputQ, OutputQ, config, logger
-from cliptalk.engines import detect_lang
-from cliptalk.qt_server import run_qt_app
+from cliptalk import (
+    AudioBuffer,
+    AudioSink,
+    InputQ,
+    OutputQ,
+    Text,
+    audio_budget,
+    config,
+    dedup,
+    encode,
+    health,
+    ipc,
+    logger,
+    metrics,
+    trace,
+    warmup,
+)
+from cliptalk.broadcast import broadcaster
+from cliptalk.cache import audio_cache
+from cliptalk.schedule import scheduler
+from cliptalk.segment import (
+    EngineLimit,
+    Hedge,
+    Part,
+    Progress,
+    script_runs,
+    split_runs,
+    synthesize,
+)
+from cliptalk.status import publisher
+
+try:
+    from cliptalk import dsp
+except ImportError:  # numpy is optional
+    dsp = None
+    logger.info('numpy not found; PCM audio will not be post-processed.')
 
 this_dir = Path(__file__).parent
 
+# (engine of the item's lang, parts, hedges)
+Route = tuple[str, list[Part], dict[str, Hedge]]
+
+
+def _has_voices(
+    voice_id: Callable[[str], str], langs: Collection[str]
+) -> bool:
+    """Whether an engine has a voice of its own for each of `langs`."""
+    return len({voice_id(lang) for lang in langs}) == len(langs)
+
+
+async def prefetch_audio(
+    in_q: InputQ,
+    trace_id: str,
+    text: str,
+    lang: str,
+    audio_q: AudioBuffer,
+    route: Route,
+    reroute: Callable[[], Awaitable[Route | None]],
+    workers: Semaphore,
+    order: int,
+):
+    engine, parts, hedges = route
+    short_text = text[:20] + '...'
+    try:
+        async with workers:
+            started = monotonic()
+            trace.mark(trace_id, 'synthesis_started', engine=engine, lang=lang)
+            # retries resume instead of repeating audio that was sent
+            progress = Progress()
+            processor = None
+            if dsp is not None and dsp.enabled():
+                processor = dsp.Processor(audio_q, engine)
+            for _ in range(3):
+                try:
+                    await synthesize(
+                        parts,
+                        processor or audio_q,
+                        hedges,
+                        progress,
+                        audio_q.wait_for_budget,
+                        order,
+                    )
+                    if processor is not None:
+                        await processor.flush()
+                except QueueShutDown:
+                    raise
+                except Exception as e:
+                    logger.debug(f'Retrying {e!r}.')
+                    metrics.retries.inc(engine, lang)
+                    # engines that went out of service are replaced
+                    if (route := await reroute()) is not None:
+                        i = progress.done
+                        if (
+                            encode.ffmpeg is None
+                            and progress.format is not None
+                            and any(
+                                new[0] != old[0]
+                                for new, old in zip(route[1][i:], parts[i:])
+                            )
+                        ):
+                            # the other engine's audio may be in a format
+                            # that cannot be converted to the one sent
+                            continue
+                        if i < len(parts) and route[1][i][0] != parts[i][0]:
+                            # the audio that was sent is not in its render
+                            progress.restart_part(parts[i][1])
+                        engine, parts, hedges = route
+                    continue
+                logger.info(f'Audio cached for: {short_text}')
+                synthesis = monotonic() - started
+                metrics.synthesis_time.observe(synthesis, engine, lang)
+                if (first_chunk_time := audio_q.first_chunk_time) is not None:
+                    scheduler.synthesized(
+                        audio_q,
+                        engine,
+                        len(text),
+                        synthesis,
+                        first_chunk_time - started,
+                    )
+                trace.mark(trace_id, 'synthesized')
+                break
+            else:
+                metrics.failures.inc(engine, lang)
+                trace.mark(trace_id, 'failed')
+            if (first_chunk_time := audio_q.first_chunk_time) is not None:
+                metrics.time_to_first_chunk.observe(
+                    first_chunk_time - started, engine, lang
+                )
+                trace.mark(
+                    trace_id,
+                    'first_chunk',
+                    at=time() - (monotonic() - first_chunk_time),
+                )
+    except QueueShutDown:
+        logger.debug(f'audio_q QueueShutDown for {short_text}')
+    except Exception as e:
+        logger.error(f'Error prefetching audio for {short_text}: {e!r}')
+    finally:
+        logger.debug('calling audio_q.shutdown()')
+        audio_q.shutdown()
+        metrics.queue_peak.set_max(len(audio_q.chunks), 'audio')
+        in_q.task_done()
+
 
 async def prefetch_audio_loop(
     in_q: InputQ,
     out_q: OutputQ,
 ):
-    """Prefetch audio for all texts in the queue."""
-    engines = load_engines()
-    try:
-        while True:
-            text = await in_q.get()
-            lang = detect_lang(text)
-            short_text = text[:20] + '...'
-            audio_q = AudioQ()
-            await out_q.put((text, lang == 'fa', audio_q))
-            fetcher = engines.get(lang) or engines['default']
+    """
+    Prefetch audio for all texts in the queue.
+
+    Up to PREFETCH_WORKERS texts are synthesized at the same time, limited
+    per engine by ENGINE_CONCURRENCY, and each starts only when the
+    scheduler finds that playback is about to need it. Audio queues are put
+    into out_q in the order that texts are taken from in_q, so playback order
+    is preserved no matter which synthesis finishes first. Mixed-script
+    texts are split into runs that are each read by the engine of their
+    language, unless their audio cannot be converted to a single format.
+    """
+    # fetchers by engine name, loaded on first use
+    engines: dict[str, Callable[[str, str, AudioSink], Awaitable]] = {}
+    voice_ids: dict[str, Callable[[str], str]] = {}
+    workers = Semaphore(config.PREFETCH_WORKERS)
+    engine_limits = {
+        engine: EngineLimit(config.ENGINE_CONCURRENCY.get(engine, 1))
+        for engine in set(config.ENGINES.values())
+    }
+    tasks: set[Task] = set()
+    # items play in the order they are taken from in_q
+    orders = count()
+
+    async def load(hint: str | None, lang: str) -> str | None:
+        """Load the engine of `lang`; a hint falls back to the configured."""
+        configured = config.ENGINES[
+            lang if lang in config.ENGINES else 'default'
+        ]
+        # engines that are out of service are replaced by their fallbacks
+        for engine in dict.fromkeys(
+            health.route(e) for e in (hint or configured, configured)
+        ):
+            if engine in engines:
+                return engine
             try:
-                for _ in range(3):
-                    try:
-                        await fetcher(text, lang, audio_q)
-                    except Exception as e:
-                        logger.debug(f'Retrying {e!r}.')
-                        continue
-                    logger.info(f'Audio cached for: {short_text}')
-                    break
-            except QueueShutDown:
-                logger.debug(f'audio_q QueueShutDown for {short_text}')
+                # cache hits neither count for nor wait for the engine's health
+                engines[engine] = await warmup.load_engine(
+                    engine, health.tracked
+                )
+                voice_ids[engine] = await warmup.load_voice_id(engine)
             except Exception as e:
-                logger.error(
-                    f'Error prefetching audio for {short_text}: {e!r}'
+                logger.error(f'Could not load engine {engine}: {e!r}')
+                continue
+            if engine not in engine_limits:
+                engine_limits[engine] = EngineLimit(
+                    config.ENGINE_CONCURRENCY.get(engine, 1)
                 )
-            finally:
-                logger.debug('calling audio_q.shutdown()')
+            return engine
+        return None
+
+    async def route_runs(
+        runs: list[tuple[str, str]], lang: str, hint: str | None
+    ) -> Route | None:
+        """Route `runs` to engines in service; None if one cannot load."""
+        run_engines = {
+            run_lang: await load(hint, run_lang)
+            for run_lang in dict.fromkeys(run_lang for run_lang, _ in runs)
+        }
+        if None in run_engines.values():
+            return None
+        if encode.ffmpeg is None and len(set(run_engines.values())) > 1:
+            # Without ffmpeg, audio of different engines cannot be joined.
+            # One engine reads all runs if it has a voice for each language.
+            for e in dict.fromkeys((run_engines[lang], *run_engines.values())):
+                if _has_voices(voice_ids[e], run_engines):  # type: ignore
+                    run_engines = dict.fromkeys(run_engines, e)
+                    break
+        parts = split_runs(
+            [
+                (engines[e], run, run_lang, engine_limits[e])
+                for run_lang, run in runs
+                if (e := run_engines[run_lang]) is not None
+            ]
+        )
+        hedges: dict[str, Hedge] = {}
+        for run_lang, primary in run_engines.items():
+            key = run_lang if run_lang in config.HEDGES else 'default'
+            hedge = config.HEDGES.get(key)
+            # without ffmpeg, hedges would mix formats, too
+            if hedge is None or encode.ffmpeg is None:
+                continue
+            fallback, deadline = hedge
+            # load falls back to the primary engine, which is no hedge
+            e = await load(fallback, run_lang)
+            if e is not None and e != primary:
+                hedges[run_lang] = (engines[e], engine_limits[e], deadline)
+        return run_engines[lang], parts, hedges  # type: ignore
+
+    try:
+        while True:
+            item = await in_q.get()
+            trace_id, text = item.trace_id, item.text
+            trace.mark(trace_id, 'dequeued')
+            runs = [(item.lang, text)] if item.lang else script_runs(text)
+            # the language with most characters names the item
+            lengths: dict[str, int] = {}
+            for run_lang, run in runs:
+                lengths[run_lang] = lengths.get(run_lang, 0) + len(run)
+            lang = max(lengths, key=lengths.__getitem__)
+            audio_q = AudioBuffer()
+            await out_q.put((trace_id, text, lang == 'fa', audio_q))
+            trace.mark(trace_id, 'output_queued')
+            reroute = partial(route_runs, runs, lang, item.engine)
+            if (route := await reroute()) is None:
+                trace.mark(trace_id, 'failed')
                 audio_q.shutdown()
-                await in_q.atask_done()
+                in_q.task_done()
+                continue
+            engine = route[0]
+            await scheduler.wait(engine, len(text))
+            if audio_q.cancelled:  # skipped while waiting
+                in_q.task_done()
+                continue
+            scheduler.started(audio_q, engine, len(text))
+            publisher.track(trace_id, audio_q)
+            task = create_task(
+                prefetch_audio(
+                    in_q,
+                    trace_id,
+                    text,
+                    lang,
+                    audio_q,
+                    route,
+                    reroute,
+                    workers,
+                    next(orders),
+                )
+            )
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
     except Exception:
         logger.critical('Fatal Error')
 
 
-def load_engines() -> dict[str, Callable[[str, str, AudioQ], Awaitable]]:
-    """
-    piper engine uses a lot more memory, but is usually more responsive.
-    edge engine uses the Microsoft Edge tts servers.
-    sapi uses Microsoft Speech API (SAPI). It has limited features,
-        but is usually the most responsive one.
-    """
-    engines: dict = config.ENGINES
-
-    for lang, engine in engines.items():
-        match engine:
-            case 'edge':
-                from cliptalk.engines.edge import prefetch_audio
-
-                engines[lang] = prefetch_audio
-
-            case 'sapi':
-                from cliptalk.engines.sapi import prefetch_audio
-
-                engines[lang] = prefetch_audio
-
-            case 'piper':
-                from cliptalk.engines.piper import prefetch_audio
-
-                engines[lang] = prefetch_audio
-            case _:
-                raise ValueError('unknown engine')
-
-    return engines
-
-
 routes = RouteTableDef()
 
 
-in_q = InputQ(
-    maxsize=50, action='input-queue-size', current_ws_container=globals()
-)
+in_q = InputQ('input', publisher.set_queue, maxsize=50)
 out_q = OutputQ(
-    maxsize=5, action='output-queue-size', current_ws_container=globals()
+    'output', publisher.set_queue, maxsize=config.PREFETCH_MAX_ITEMS
 )
 
 
@@ -107,7 +336,8 @@ out_q = OutputQ(
 async def _(request: Request) -> Response:
     logger.debug('/monitoring recieved request')
     new_state = await request.json()
-    conn.send(new_state)
+    if qt_writer is not None:
+        ipc.write_frame(qt_writer, ipc.MONITORING, bytes([new_state]))
     logger.info(f'monitoring state: {new_state}')
     return Response()
 
@@ -118,76 +348,264 @@ monitor_clipboard_args = [
 ]
 
 
-async def listen_to_qt():
-    """Monitor clipboard and add texts to queue."""
-    while True:
-        try:
-            data = await to_thread(conn.recv)
+# random token that the Qt process must present, see ipc
+ipc_token = token_bytes(16)
+qt_writer: StreamWriter | None = None
 
-            if type(data) is bool:
-                logger.debug(f'qt toggled monitoring: {data}')
-                if current_ws is None:
-                    continue
-                await current_ws.send_json(
-                    {'action': 'toggle-monitoring', 'state': data}
+
+async def listen_to_qt(reader: StreamReader, writer: StreamWriter):
+    """Monitor clipboard and add texts to queue."""
+    global qt_writer
+    try:
+        # nothing more than a token is read from an unknown peer
+        kind, payload = await ipc.read_frame(reader, len(ipc_token))
+    except (IncompleteReadError, ipc.FrameTooLarge):
+        kind, payload = None, b''
+    if kind != ipc.HELLO or not compare_digest(payload, ipc_token):
+        logger.warning('Rejected an IPC connection without a valid token')
+        writer.close()
+        return
+    qt_writer = writer
+    ipc.write_frame(
+        writer,
+        ipc.SETTINGS,
+        json.dumps([config.MIN_SPACE_RATIO, config.MIN_TEXT_LENGTH]).encode(),
+    )
+    try:
+        while True:
+            try:
+                kind, payload = await ipc.read_frame(
+                    reader, config.IPC_MAX_FRAME_SIZE
                 )
+            except ipc.FrameTooLarge as e:
+                logger.warning(f'Skipped an IPC message: {e}')
+                await ipc.skip_payload(reader, e.size)
                 continue
+            try:
+                match kind:
+                    case ipc.MONITORING:
+                        state = payload == b'\1'
+                        logger.debug(f'qt toggled monitoring: {state}')
+                        await broadcaster.send_json(
+                            {'action': 'toggle-monitoring', 'state': state}
+                        )
+                    case ipc.TEXT:
+                        trace_id, captured, sent, text = ipc.parse_text(
+                            payload
+                        )
+                        trace.start(
+                            trace_id, text, captured=captured, sent=sent
+                        )
+                        trace.mark(trace_id, 'received')
+                        text = text.strip()
+                        fp = dedup.fingerprint(text)
+                        if (other := dedup.pending.get(fp)) is not None:
+                            trace.mark(trace_id, 'collapsed', into=other)
+                            continue
+                        dedup.pending[fp] = trace_id
+                        await in_q.put(Text(trace_id, text))
+                        trace.mark(trace_id, 'queued')
+                    case _:
+                        logger.error(f'Unexpected IPC message kind: {kind}')
+            except Exception as e:
+                logger.error(f'listen_to_qt loop failed with {e!r}')
+    except (IncompleteReadError, ConnectionError):
+        logger.info('Qt process disconnected')
+    finally:
+        qt_writer = None
+        writer.close()
+
+
+def _parse_texts(data) -> list[Text]:
+    """Accept a text, a list of texts, or {"texts": [...]} with hints."""
+    if isinstance(data, dict) and 'texts' in data:
+        data = data['texts']
+    if not isinstance(data, list):
+        data = [data]
+    # only engines that are configured are loaded and warmed up
+    engines = {
+        *config.ENGINES.values(),
+        *(engine for engine, _ in config.HEDGES.values()),
+        *config.FALLBACK_ENGINES.values(),
+    }
+    texts = []
+    for entry in data:
+        if isinstance(entry, str):
+            entry = {'text': entry}
+        if not isinstance(entry, dict):
+            raise ValueError(f'invalid entry: {entry!r}')
+        text = entry.get('text')
+        lang = entry.get('lang')
+        engine = entry.get('engine')
+        priority = entry.get('priority', 0)
+        if not isinstance(text, str) or not (text := text.strip()):
+            raise ValueError('every entry needs a non-empty text')
+        if lang is not None and not isinstance(lang, str):
+            raise ValueError(f'invalid lang: {lang!r}')
+        if engine is not None and engine not in engines:
+            raise ValueError(f'engine not configured: {engine!r}')
+        if type(priority) is not int:
+            raise ValueError(f'invalid priority: {priority!r}')
+        texts.append(Text(trace.new_id(), text, lang, engine, priority))
+    return texts
+
+
+@routes.post('/texts')
+async def _(request: Request) -> Response:
+    """
+    Queue texts for reading, e.g. {"texts": ["first", {"text": "second",
+    "lang": "fa", "engine": "edge", "priority": 1}]}. Higher priorities are
+    read first. Responds 429 without queuing anything if in_q is full.
+
+    Texts equal to one that is still waiting to be played are collapsed
+    into it; `ids` then holds the ID of the waiting item.
+    """
+    try:
+        texts = _parse_texts(await request.json())
+    except ValueError as e:  # includes JSONDecodeError
+        raise HTTPBadRequest(text=str(e)) from None
+    if len(texts) > in_q.maxsize:
+        raise HTTPRequestEntityTooLarge(
+            max_size=in_q.maxsize,
+            actual_size=len(texts),
+            text=f'At most {in_q.maxsize} texts can be queued.',
+        )
+    # the ID each text is read under, and fingerprints of the new ones
+    ids: list[str] = []
+    new: dict[bytes, Text] = {}
+    for t in texts:
+        fp = dedup.fingerprint(t.text)
+        other = dedup.pending.get(fp) or (
+            new[fp].trace_id if fp in new else None
+        )
+        if other is None:
+            new[fp] = t
+        ids.append(other or t.trace_id)
+    now = time()
+    for t in new.values():
+        trace.start(t.trace_id, t.text, captured=now)
+    try:
+        in_q.put_all_nowait([*new.values()])
+    except QueueFull:
+        return json_response(
+            {'accepted': 0, 'free': in_q.maxsize - in_q.qsize()},
+            status=429,
+            headers={'Retry-After': '1'},
+        )
+    for fp, t in new.items():
+        dedup.pending[fp] = t.trace_id
+        trace.mark(t.trace_id, 'queued')
+    return json_response(
+        {
+            'accepted': len(new),
+            'collapsed': len(texts) - len(new),
+            'ids': ids,
+        },
+        status=202,
+    )
+
+
+@routes.get('/ready')
+async def _(_) -> Response:
+    report = warmup.ready_report()
+    report['health'] = {
+        name: engine.to_dict() for name, engine in health.engines.items()
+    }
+    return json_response(report, status=200 if report['ready'] else 503)
+
+
+@routes.get('/cache')
+async def _(_) -> Response:
+    return json_response(audio_cache.stats())
+
+
+@routes.get('/metrics')
+async def _(_) -> Response:
+    for name, q in (('input', in_q), ('output', out_q)):
+        metrics.queue_depth.set(q.qsize(), name)
+        metrics.queue_peak.set_max(q.peak, name)
+    metrics.prefetch_ahead.set(scheduler.ahead())
+    metrics.audio_buffered_bytes.set(audio_budget.used)
+    for name, engine in health.engines.items():
+        metrics.engine_up.set(int(engine.available), name)
+    for engine, rate in scheduler.rates.items():
+        metrics.real_time_factor.set(rate.real_time_factor, engine)
+    current = broadcaster.current
+    metrics.queue_depth.set(
+        0 if current is None else len(current.buffer.chunks), 'audio'
+    )
+    return Response(
+        text=metrics.render(),
+        # the version of the exposition format
+        content_type='text/plain; version=0.0.4',
+        headers={'X-Content-Type-Options': 'nosniff'},
+    )
 
-            if type(data) is str:
-                data = data.strip()
-                await in_q.put(data)
-                continue
 
-            logger.error(f'Unexpected data type recieved from conn: {data=}')
-        except Exception as e:
-            logger.error(f'listen_to_qt loop failed with {e!r}')
+def _int_query(request: Request, name: str) -> int | None:
+    value = request.query.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPBadRequest(text=f'invalid {name}') from None
 
 
-next_request = Event()
+def _item_id(request: Request) -> int | None:
+    return _int_query(request, 'id')
 
 
 @routes.get('/next')
 async def _(request: Request) -> Response:
     logger.debug('recieved /next request')
-    current_audio_q.shutdown(immediate=True)
-    next_request.set()
+    item_id = _item_id(request)
+    if (item := broadcaster.get_item(item_id)) is not None:
+        skipped = 'skip' in request.query
+        trace.mark(item.trace_id, 'skipped' if skipped else 'ended')
+        scheduler.finished(item.buffer)
+    if 'skip' in request.query:
+        broadcaster.skip(item_id)
+    else:
+        broadcaster.finished(_int_query(request, 'listener') or 0, item_id)
+    return Response()
+
+
+@routes.get('/event')
+async def _(request: Request) -> Response:
+    """Playback events reported by the front-end."""
+    item = broadcaster.get_item(_item_id(request))
+    if item is None:
+        return Response()
+    name = request.query.get('name')
+    if name == 'playing':
+        trace.mark(item.trace_id, 'playing')
+    if name in ('playing', 'progress'):
+        try:
+            position = float(request.query.get('t', 0))
+        except ValueError:
+            raise HTTPBadRequest(text='invalid t') from None
+        scheduler.progress(item.buffer, position)
     return Response()
 
 
-current_ws: WebSocketResponse | None = None
+@routes.get('/traces')
+async def _(_) -> Response:
+    return json_response(trace.recent())
 
 
 @routes.get('/ws')
 async def _(request):
-    global current_audio_q, current_ws
     logger.info('new websocket connection')
-
     ws = WebSocketResponse()
     await ws.prepare(request)
-    if current_ws and not current_ws.closed:
-        logger.debug('closing current_ws before using new one')
-        await current_ws.close()
-
-    current_ws = ws
-
-    while True:
-        text, is_fa, audio_q = await out_q.get()
-        logger.info('Sending new clipboard text to front-end.')
-        # Store audio_q in request.app for /audio endpoint
-        current_audio_q = audio_q
-        next_request.clear()
-        try:
-            await ws.send_json(
-                {'action': 'new-text', 'text': text, 'is_fa': is_fa}
-            )
-        except Exception as e:
-            logger.exception(f'WebSocket error: {e}')
-            await ws.close()
-            return ws
-        finally:
-            await out_q.atask_done()
-        logger.debug('awaiting next_request')
-        await next_request.wait()
+    listener = await broadcaster.add_listener(ws)
+    try:
+        async for _ in ws:
+            pass
+    finally:
+        broadcaster.remove_listener(listener)
+    return ws
 
 
 @routes.get('/cliptalk.html')
@@ -216,57 +634,195 @@ async def _(_):
 
 audio_headers = {
     'Access-Control-Allow-Origin': '*',
-    'Content-Type': 'audio/wav',
+    'Accept-Ranges': 'bytes',
     'Cache-Control': 'no-cache',
     'Connection': 'keep-alive',
 }
 
 
+async def serve_buffered(
+    request: Request, buffer: AudioBuffer, http_range: slice
+) -> StreamResponse:
+    """Serve the complete audio of `buffer` from memory."""
+    total = buffer.size
+    headers = audio_headers | {'Content-Type': buffer.content_type}
+    if http_range.start is None and http_range.stop is None:
+        start, stop, status = 0, total, 200
+    else:
+        start, stop, _ = http_range.indices(total)
+        if start >= stop:
+            raise HTTPRequestRangeNotSatisfiable(
+                headers={'Content-Range': f'bytes */{total}'}
+            )
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{total}'
+    response = StreamResponse(status=status, headers=headers)
+    response.content_length = stop - start
+    await response.prepare(request)
+    for data in buffer.slices(start, stop):
+        await response.write(data)
+    metrics.audio_bytes.inc(amount=stop - start)
+    return response
+
+
+async def serve_available(
+    request: Request, buffer: AudioBuffer, http_range: slice
+) -> StreamResponse:
+    """
+    Serve the part of a range that has been synthesized so far, for seeking
+    into audio that is not complete yet. The player asks for the rest later.
+    """
+    start = http_range.start
+    if start < 0:  # a suffix range needs the final size
+        await buffer.wait_done()
+        return await serve_buffered(request, buffer, http_range)
+    await buffer.wait_for_size(start + 1)
+    if buffer.done:
+        return await serve_buffered(request, buffer, http_range)
+    size = buffer.size
+    stop = size if http_range.stop is None else min(http_range.stop, size)
+    response = StreamResponse(
+        status=206,
+        headers=audio_headers
+        | {
+            'Content-Type': buffer.content_type,
+            'Content-Range': f'bytes {start}-{stop - 1}/*',
+        },
+    )
+    response.content_length = stop - start
+    await response.prepare(request)
+    for data in buffer.slices(start, stop):
+        # the growing block must not stay exported while writing
+        await response.write(
+            bytes(data) if type(data.obj) is bytearray else data
+        )
+    metrics.audio_bytes.inc(amount=stop - start)
+    return response
+
+
+async def serve_encoded(
+    request: Request, buffer: AudioBuffer, audio_format: str
+) -> StreamResponse:
+    response = StreamResponse(
+        status=200,
+        headers=audio_headers
+        | {
+            'Accept-Ranges': 'none',
+            'Content-Type': encode.content_type(audio_format),
+        },
+    )
+    await response.prepare(request)
+    try:
+        async with aclosing(encode.encode(buffer, audio_format)) as chunks:
+            async for data in chunks:
+                await response.write(data)
+                metrics.audio_bytes.inc(amount=len(data))
+    except Exception as e:
+        logger.error(f'unexpected error while encoding: {e!r}')
+    return response
+
+
 @routes.get('/audio')
 async def _(request: Request) -> StreamResponse:
-    audio_q = current_audio_q
+    item = broadcaster.get_item(_item_id(request))
+    if item is None:
+        raise HTTPNotFound()
+    buffer = item.buffer
+    try:
+        http_range = request.http_range
+    except ValueError:
+        raise HTTPRequestRangeNotSatisfiable() from None
     logger.info('Serving audio started.')
-    response = StreamResponse(status=200, reason='OK', headers=audio_headers)
+    trace.mark(item.trace_id, 'audio_requested')
+    await buffer.wait_for_data()
+    trace.mark(item.trace_id, 'audio_first_byte')
+    if buffer.content_type == 'audio/wav' and (
+        audio_format := encode.negotiate(request)
+    ):
+        return await serve_encoded(request, buffer, audio_format)
+    if http_range.start and not buffer.done:
+        return await serve_available(request, buffer, http_range)
+    if buffer.done:
+        return await serve_buffered(request, buffer, http_range)
+
+    response = StreamResponse(
+        status=200,
+        reason='OK',
+        headers=audio_headers | {'Content-Type': buffer.content_type},
+    )
     await response.prepare(request)
     try:
-        while True:
-            data = await audio_q.get()
+        async for data in buffer.read():
             await response.write(data)
-            audio_q.task_done()
-    except QueueShutDown:
-        logger.debug('/audio reached QueueShutDown')
+            metrics.audio_bytes.inc(amount=len(data))
     except Exception as e:
         logger.error(f'unexpected error: {e!r}')
     return response
 
 
+def print_listening(message: str):
+    """Called by run_app once the server is accepting connections."""
+    warmup.milestone('listening')
+    print(message)
+
+
 async def open_tab_if_no_conn():
     await sleep(5.0)
-    if current_ws is None:
-        webbrowser.open('http://127.0.0.1:3775/cliptalk.html')
+    if not broadcaster.listeners:
+        webbrowser.open(f'http://127.0.0.1:{config.PORT}/cliptalk.html')
+
+
+async def close_engines(_: Application):
+    # engines are imported on first use; Edge keeps a client session open
+    if (edge := sys.modules.get('cliptalk.engines.edge')) is not None:
+        await edge.pool.close()
 
 
 if __name__ == '__main__':
+    if '--profile-startup' in sys.argv[1:]:
+        config.PROFILE_STARTUP = config.PROFILE_STARTUP or Path('startup.prof')
+    if config.PROFILE_STARTUP is not None:
+        warmup.start_profiling()
+    warmup.milestone('imports done')
+    headless = config.HEADLESS or '--headless' in sys.argv[1:]
+
     app = Application()
     app.add_routes(routes)
+    app.on_cleanup.append(close_engines)
 
     loop = new_event_loop()
     create_task = loop.create_task
     # loop.create_task(set_voice_names())
 
-    qt_conn, conn = Pipe(True)
-    conn.send((config.MIN_SPACE_RATIO, config.MIN_TEXT_LENGTH))
-    qt_process = Process(target=run_qt_app, args=(qt_conn,))
-    qt_process.start()
-    listen_to_qt_task = create_task(listen_to_qt())
+    qt_process = None
+    if not headless:
+        # Qt is only needed for clipboard monitoring, not for the server.
+        from cliptalk.qt_server import run_qt_app
+
+        ipc_server = loop.run_until_complete(
+            start_server(listen_to_qt, '127.0.0.1', 0)
+        )
+        ipc_port = ipc_server.sockets[0].getsockname()[1]
+        qt_process = Process(target=run_qt_app, args=(ipc_port, ipc_token))
+        qt_process.start()
+        open_tab_task = create_task(open_tab_if_no_conn())
+    warmup_task = create_task(warmup.warm_up())
     prefetch_audio_task = create_task(prefetch_audio_loop(in_q, out_q))
-    open_tab_task = create_task(open_tab_if_no_conn())
+    broadcast_task = create_task(broadcaster.run(out_q))
+    status_task = create_task(publisher.run(broadcaster.send_json))
 
     try:
-        run_app(app, host='127.0.0.1', port=3775, loop=loop)
+        run_app(
+            app,
+            host=config.HOST,
+            port=config.PORT,
+            loop=loop,
+            print=print_listening,
+        )
     except KeyboardInterrupt:
         pass
     finally:
-        qt_process.terminate()
+        if qt_process is not None:
+            qt_process.terminate()
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
@@ -0,0 +1,251 @@
+"""
+End-to-end latency and throughput benchmark.
+
+Runs the aiohttp app headlessly on a random port, injects texts into in_q
+the way listen_to_qt does and plays them back with websocket listeners that
+download /audio as fast as possible. All engines are replaced with the fake
+engine, so results only reflect the pipeline itself.
+
+    python -m cliptalk.benchmark --items 20 --output benchmark.jsonl
+
+The result is printed as JSON; with --output it is also appended as a single
+line, which makes runs of different commits easy to compare.
+"""
+
+import json
+import subprocess
+import sys
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from asyncio import create_task, gather, run, sleep
+from statistics import fmean, median, quantiles
+from time import perf_counter, time
+
+from aiohttp import ClientSession, WSMsgType
+from aiohttp.web import Application, AppRunner, TCPSite
+
+import cliptalk.__main__ as server
+from cliptalk import Text, __version__, config, logger, trace
+from cliptalk.broadcast import broadcaster
+from cliptalk.cache import audio_cache
+
+SENTENCE = 'The quick brown fox jumps over the lazy dog. '
+
+
+def make_text(i: int, chars: int) -> str:
+    # unique per item, so that none of them are collapsed or cached
+    text = f'Item {i}. '
+    return (text + SENTENCE * (chars // len(SENTENCE) + 1))[:chars]
+
+
+def summarize(values: list[float]) -> dict | None:
+    if not values:
+        return None
+    return {
+        'min': min(values),
+        'mean': fmean(values),
+        'median': median(values),
+        # inclusive: the default extrapolates beyond max for few values
+        'p95': quantiles(values, n=20, method='inclusive')[-1]
+        if len(values) > 1
+        else values[0],
+        'max': max(values),
+    }
+
+
+def peak_rss() -> int | None:
+    """Peak resident set size of the process in bytes, where available."""
+    try:
+        from resource import RUSAGE_SELF, getrusage
+    except ImportError:  # Windows
+        return None
+    rss = getrusage(RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def listen(
+    session: ClientSession, home: str, items: int, received: list[dict]
+):
+    """Play `items` items as fast as possible, like cliptalk.js does."""
+    async with session.ws_connect(f'{home}ws') as ws:
+        listener = 0
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                break
+            data = message.json()
+            if data['action'] == 'hello':
+                listener = data['listener']
+                continue
+            if data['action'] != 'new-text':
+                continue
+            item_id = data['id']
+            first_byte = None
+            size = 0
+            async with session.get(f'{home}audio?id={item_id}') as response:
+                async for chunk in response.content.iter_any():
+                    if first_byte is None:
+                        first_byte = perf_counter()
+                    size += len(chunk)
+            received.append(
+                {
+                    'text': data['text'],
+                    'first_byte': first_byte,
+                    'end': perf_counter(),
+                    'bytes': size,
+                }
+            )
+            async with session.get(
+                f'{home}next?id={item_id}&listener={listener}'
+            ):
+                pass
+            if len(received) == items:
+                return
+
+
+async def inject(texts: list[str], interval: float, injected: dict):
+    for text in texts:
+        injected[text] = perf_counter()
+        trace_id = trace.new_id()
+        trace.start(trace_id, text, captured=time())
+        await server.in_q.put(Text(trace_id, text))
+        await sleep(interval)
+
+
+async def benchmark(args: Namespace) -> dict:
+    config.ENGINES = {'default': 'fake'}
+    config.ENGINE_CONCURRENCY = config.ENGINE_CONCURRENCY | {
+        'fake': args.engine_concurrency
+    }
+    config.FAKE_LATENCY = args.latency
+    config.FAKE_CHUNK_INTERVAL = args.chunk_interval
+    config.FAKE_CHUNK_SIZE = args.chunk_size
+    audio_cache.max_bytes = 0  # measure synthesis, not the disk cache
+    # listeners consume audio at once, so there is no playback to pace
+    config.PREFETCH_MARGIN = float('inf')
+
+    app = Application()
+    app.add_routes(server.routes)
+    runner = AppRunner(app)
+    await runner.setup()
+    site = TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    home = f'http://127.0.0.1:{runner.addresses[0][1]}/'
+    tasks = [
+        create_task(server.prefetch_audio_loop(server.in_q, server.out_q)),
+        create_task(broadcaster.run(server.out_q)),
+    ]
+
+    texts = [make_text(i, args.chars) for i in range(args.items)]
+    injected: dict[str, float] = {}
+    received: list[list[dict]] = [[] for _ in range(args.listeners)]
+    try:
+        async with ClientSession() as session:
+            listeners = [
+                create_task(listen(session, home, args.items, r))
+                for r in received
+            ]
+            while len(broadcaster.listeners) < args.listeners:
+                await sleep(0.01)
+            started = perf_counter()
+            await inject(texts, args.interval, injected)
+            await gather(*listeners)
+            finished = perf_counter()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await runner.cleanup()
+
+    first_byte_ms = []
+    total_ms = []
+    gap_ms = []
+    for items in received:
+        previous_end = None
+        for item in items:
+            start = injected[item['text']]
+            first_byte = item['first_byte'] or item['end']
+            first_byte_ms.append((first_byte - start) * 1000)
+            total_ms.append((item['end'] - start) * 1000)
+            if previous_end is not None:
+                gap_ms.append((first_byte - previous_end) * 1000)
+            previous_end = item['end']
+
+    return {
+        'version': __version__,
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'parameters': vars(args),
+        'first_byte_ms': summarize(first_byte_ms),
+        'total_ms': summarize(total_ms),
+        'gap_ms': summarize(gap_ms),
+        'items_per_second': args.items / (finished - started),
+        'audio_bytes': sum(item['bytes'] for item in received[0]),
+        'peak_rss_bytes': peak_rss(),
+        'peak_traced_bytes': (
+            tracemalloc.get_traced_memory()[1]
+            if tracemalloc.is_tracing()
+            else None
+        ),
+    }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--items', type=int, default=20)
+    parser.add_argument(
+        '--chars', type=int, default=300, help='length of each text'
+    )
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=0.0,
+        help='seconds between injected texts; 0 injects a burst',
+    )
+    parser.add_argument('--listeners', type=int, default=1)
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=config.FAKE_LATENCY,
+        help='seconds until the first chunk of each segment',
+    )
+    parser.add_argument(
+        '--chunk-interval', type=float, default=config.FAKE_CHUNK_INTERVAL
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=config.FAKE_CHUNK_SIZE
+    )
+    parser.add_argument('--engine-concurrency', type=int, default=4)
+    parser.add_argument(
+        '--tracemalloc',
+        action='store_true',
+        help='also report the peak of Python allocations (slower)',
+    )
+    parser.add_argument(
+        '--output', help='append the result as a JSON line to this file'
+    )
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    if args.tracemalloc:
+        tracemalloc.start()
+    result = run(benchmark(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a', encoding='utf8') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Fan synthesized items out to any number of listeners.
+
+Each item's audio is kept in an AudioBuffer that every listener reads with
+its own cursor, so synthesis is never duplicated per listener. Playback moves
+on to the next item once every connected listener has finished the current
+one (or someone skips it). Only the last BROADCAST_HISTORY items are kept.
+"""
+
+from asyncio import Event
+from collections import OrderedDict
+from itertools import count
+
+from aiohttp import ClientConnectionResetError
+from aiohttp.web import WebSocketResponse
+
+from cliptalk import AudioBuffer, OutputQ, config, dedup, logger, trace
+from cliptalk.status import publisher
+
+
+class Item:
+    def __init__(
+        self,
+        id: int,
+        trace_id: str,
+        text: str,
+        is_fa: bool,
+        buffer: AudioBuffer,
+        replay: bool = False,
+    ):
+        self.id = id
+        self.trace_id = trace_id
+        self.text = text
+        self.is_fa = is_fa
+        self.buffer = buffer
+        # the same text was played within REPLAY_WINDOW
+        self.replay = replay
+
+    def message(self) -> dict:
+        return {
+            'action': 'new-text',
+            'id': self.id,
+            'text': self.text,
+            'trace': self.trace_id,
+            'is_fa': self.is_fa,
+            'replay': self.replay,
+        }
+
+
+class Broadcaster:
+    def __init__(self):
+        self.listeners: dict[int, WebSocketResponse] = {}
+        self.items: OrderedDict[int, Item] = OrderedDict()
+        self.current: Item | None = None
+        # listeners that have not finished the current item yet
+        self.pending: set[int] = set()
+        self._listener_ids = count(1)
+        self._item_ids = count(1)
+        self._has_listeners = Event()
+        self._advance = Event()
+
+    async def send_json(self, data: dict):
+        for listener, ws in [*self.listeners.items()]:
+            try:
+                await ws.send_json(data)
+            except (ClientConnectionResetError, RuntimeError) as e:
+                logger.warning(f'Could not send to listener {listener}: {e!r}')
+
+    async def add_listener(self, ws: WebSocketResponse) -> int:
+        listener = next(self._listener_ids)
+        self.listeners[listener] = ws
+        self._has_listeners.set()
+        await ws.send_json({'action': 'hello', 'listener': listener})
+        await ws.send_json(publisher.message())
+        if (current := self.current) is not None:
+            # start the newcomer at the beginning of the current item
+            self.pending.add(listener)
+            await ws.send_json(current.message())
+        logger.info(f'listener {listener} joined ({len(self.listeners)})')
+        return listener
+
+    def remove_listener(self, listener: int):
+        self.listeners.pop(listener, None)
+        logger.info(f'listener {listener} left ({len(self.listeners)})')
+        if not self.listeners:
+            self._has_listeners.clear()
+            return
+        self.finished(listener, None)
+
+    def finished(self, listener: int, item_id: int | None):
+        """Record that `listener` is done with the current item."""
+        if item_id is not None and (
+            self.current is None or item_id != self.current.id
+        ):
+            return
+        self.pending.discard(listener)
+        if not self.pending:
+            self._advance.set()
+
+    def skip(self, item_id: int | None):
+        current = self.current
+        if current is None or item_id not in (None, current.id):
+            return
+        current.buffer.shutdown(immediate=True)
+        self.pending.clear()
+        self._advance.set()
+
+    def get_item(self, item_id: int | None) -> Item | None:
+        if item_id is None:
+            return self.current
+        return self.items.get(item_id)
+
+    def _remember(self, item: Item):
+        items = self.items
+        items[item.id] = item
+        while len(items) > config.BROADCAST_HISTORY:
+            _, old = items.popitem(last=False)
+            old.buffer.shutdown(immediate=True)
+
+    async def run(self, out_q: OutputQ):
+        """Hand items from out_q to all listeners, one at a time."""
+        while True:
+            await self._has_listeners.wait()
+            trace_id, text, is_fa, buffer = await out_q.get()
+            item = Item(
+                next(self._item_ids),
+                trace_id,
+                text,
+                is_fa,
+                buffer,
+                dedup.announced(text),
+            )
+            self._remember(item)
+            self.current = item
+            buffer.exempt_from_budget()
+            self.pending = {*self.listeners}
+            self._advance.clear()
+            logger.info('Sending new clipboard text to front-end.')
+            await self.send_json(item.message())
+            trace.mark(
+                trace_id,
+                'announced',
+                **({'replay': 'yes'} if item.replay else {}),
+            )
+            out_q.task_done()
+            logger.debug('awaiting listeners to finish')
+            await self._advance.wait()
+
+
+broadcaster = Broadcaster()
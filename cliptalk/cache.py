@@ -0,0 +1,166 @@
+"""
+On-disk, content-addressed audio cache that sits in front of every engine.
+
+Entries are keyed by engine, voice (including rate/length_scale) and a hash
+of the normalized text. An in-memory index keeps the entries in LRU order so
+that lookups never touch the disk and eviction does not need a directory scan.
+"""
+
+import os
+from asyncio import to_thread
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from hashlib import sha256
+from pathlib import Path
+from re import compile as rc
+from tempfile import mkstemp
+
+from cliptalk import AudioSink, config, logger
+
+Fetcher = Callable[[str, str, AudioSink], Awaitable]
+
+_collapse_whitespace = rc(r'\s+').sub
+
+
+def normalize(text: str) -> str:
+    return _collapse_whitespace(' ', text).strip()
+
+
+def cache_key(engine: str, voice: str, text: str) -> str:
+    return sha256(f'{engine}\0{voice}\0{normalize(text)}'.encode()).hexdigest()
+
+
+class AudioCache:
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # key -> size, least recently used first
+        self.index: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        if max_bytes <= 0:
+            return
+        directory.mkdir(parents=True, exist_ok=True)
+        # mtime is bumped on every hit, so it restores the LRU order
+        for _, size, path in sorted(
+            (s.st_mtime, s.st_size, p)
+            for p in directory.glob('*.audio')
+            if (s := p.stat())
+        ):
+            self.index[path.stem] = size
+            self.total_bytes += size
+        self._evict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}.audio'
+
+    def _evict(self):
+        index = self.index
+        while self.total_bytes > self.max_bytes and index:
+            key, size = index.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                self._path(key).unlink()
+            except FileNotFoundError:
+                pass
+
+    async def get(self, key: str) -> bytes | None:
+        if key not in self.index:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            data = await to_thread(path.read_bytes)
+        except OSError as e:
+            logger.warning(f'Dropping unreadable cache entry {key}: {e!r}')
+            self.total_bytes -= self.index.pop(key, 0)
+            self.misses += 1
+            return None
+        self.index.move_to_end(key)
+        self.hits += 1
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def _write(self, key: str, data: bytes):
+        # a unique temporary file, since the same text may be rendered twice
+        # at once
+        fd, tmp_path = mkstemp('.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    async def put(self, key: str, data: bytes):
+        size = len(data)
+        if not size or size > self.max_bytes:
+            return
+        try:
+            await to_thread(self._write, key, data)
+        except OSError as e:
+            logger.warning(f'Could not write cache entry {key}: {e!r}')
+            return
+        self.total_bytes += size - self.index.pop(key, 0)
+        self.index[key] = size
+        self._evict()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self.index),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+    def cached(
+        self, engine: str, fetcher: Fetcher, voice_id: Callable[[str], str]
+    ) -> Fetcher:
+        """Wrap `fetcher` so that it is only called on cache misses."""
+        if not self.enabled:
+            return fetcher
+
+        async def cached_fetcher(text: str, lang: str, audio_q: AudioSink):
+            key = cache_key(engine, voice_id(lang), text)
+            data = await self.get(key)
+            if data is not None:
+                logger.debug(f'Cache hit ({self.hits}/{self.misses})')
+                view = memoryview(data)
+                chunk_size = config.CACHE_CHUNK_SIZE
+                for i in range(0, len(view), chunk_size):
+                    await audio_q.put(bytes(view[i : i + chunk_size]))
+                return
+            recorder = _RecordingQ(audio_q)
+            await fetcher(text, lang, recorder)
+            # only complete renders reach this point
+            await self.put(key, b''.join(recorder.chunks))
+
+        return cached_fetcher
+
+
+class _RecordingQ:
+    """Forward puts to an AudioSink while keeping a copy of the audio."""
+
+    def __init__(self, audio_q: AudioSink):
+        self.audio_q = audio_q
+        self.chunks: list[bytes] = []
+
+    async def put(self, data: bytes):
+        if data:
+            self.chunks.append(data)
+        await self.audio_q.put(data)
+
+
+audio_cache = AudioCache(config.CACHE_DIR, config.CACHE_MAX_BYTES)
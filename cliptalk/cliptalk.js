@@ -1,16 +1,32 @@
-const port = '3775'
-const home = `http://127.0.0.1:${port}/`
+const home = `${location.origin}/`
 
 // @ts-check
 var audio = new Audio();
 
+var listenerId = 0;
+var itemId = 0;
+var itemTrace = '';
+// e.g. cliptalk.html?format=opus to receive compressed audio
+var audioFormat = new URLSearchParams(location.search).get('format');
+
 function requestNextStream(e) {
 	if (e.type != 'ended') {
 		console.log(e);
 	}
-	fetch(home + 'next');
+	fetch(`${home}next?id=${itemId}&listener=${listenerId}`);
 }
 audio.onended = requestNextStream;
+audio.onplaying = () => {
+	fetch(`${home}event?id=${itemId}&name=playing&t=${audio.currentTime}`);
+};
+// lets the server pace synthesis to playback
+var lastProgress = 0;
+audio.ontimeupdate = () => {
+	var now = Date.now();
+	if (now - lastProgress < 1000) return;
+	lastProgress = now;
+	fetch(`${home}event?id=${itemId}&name=progress&t=${audio.currentTime}`);
+};
 // stall may be tirggered at the very start which is due to MS TTS server delay
 // audio.onstalled = requestNextStream;
 audio.onerror = requestNextStream;
@@ -62,11 +78,12 @@ const nextButton = document.getElementById('next');
 function next() {
 	audio.pause();
 	nextButton.disabled = true;
-	fetch(home + 'next');
+	fetch(`${home}next?id=${itemId}&skip`);
 }
 
 async function play() {
-	audio.src = 'audio?' + Date.now(); // Bypasses browser cache
+	audio.src = `audio?id=${itemId}&t=${Date.now()}` // Bypasses browser cache
+		+ (audioFormat ? `&format=${audioFormat}` : '');
 	audio.play().catch((e) => {
 		console.error(e);
 	});
@@ -97,7 +114,7 @@ function onCloseOrError(e) {
 function startWs() {
 	console.log('new websocket');
 	try {
-		ws = new WebSocket(`ws://127.0.0.1:${port}/ws`);
+		ws = new WebSocket(`ws://${location.host}/ws`);
 	} catch {
 		onCloseOrError();
 		return;
@@ -111,22 +128,34 @@ function startWs() {
 	ws.onmessage = (e) => {
 		var j = JSON.parse(e.data);
 		switch (j.action) {
+			case 'hello':
+				listenerId = j.listener;
+				break;
 			case 'toggle-monitoring':
 				monitoring = j.state;
 				toggleButton.textContent = monitoring ? '⏽' : '⭘';
 				break;
 			case 'new-text':
+				itemId = j.id;
+				itemTrace = j.trace;
+				document.getElementById('synthesized').textContent = '';
 				var text = j.text;
 				editableField.dir = j.is_fa ? 'rtl' : 'ltr';
 				editableField.textContent = text;
+				document.getElementById('replay').hidden = !j.replay;
 				nextButton.disabled = false;
 				play();
 				break;
-			case 'input-queue-size':
-				document.getElementById('input-queue-size').textContent = j.value;
-				break;
-			case 'output-queue-size':
-				document.getElementById('output-queue-size').textContent = j.value;
+			case 'status':
+				for (var name in j.queues) {
+					document.getElementById(`${name}-queue-size`).textContent = j.queues[name];
+				}
+				document.getElementById('engines').textContent = Object.entries(j.engines)
+					.map(([name, state]) => `${name} ${state == 'closed' ? '✓' : '✗'}`).join(' ');
+				var item = j.items[itemTrace];
+				if (item) {
+					document.getElementById('synthesized').textContent = `${item.seconds}s${item.done ? ' ✓' : ''}`;
+				}
 				break;
 		}
 	}
@@ -1,4 +1,10 @@
-# See load_prefetch_function in __main__ for defined engines.
+from pathlib import Path
+
+# Use '0.0.0.0' to let other devices on the network listen, too.
+HOST = '127.0.0.1'
+PORT = 3775
+
+# See import_engine in engines/__init__.py for defined engines.
 ENGINES = {
     'fa': 'edge',
     'default': 'sapi',
@@ -10,3 +16,146 @@ MIN_TEXT_LENGTH = 1
 SAPI_VOICE_RATE = -2.0
 # A list of available SAPI voices are logged in the console when the app starts.
 SAPI_VOICE_NAME = 'Microsoft David Desktop'
+# Rendered audio is cached on disk and reused when the same text is copied
+# again. Least recently used entries are evicted once the directory grows
+# beyond CACHE_MAX_BYTES. Set it to 0 to disable the cache.
+CACHE_DIR = Path.home() / '.cache' / 'cliptalk'
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Size of the chunks that cached audio is streamed in.
+CACHE_CHUNK_SIZE = 64 * 1024
+# Number of texts that are synthesized concurrently ahead of playback.
+PREFETCH_WORKERS = 4
+# Maximum number of concurrent syntheses per engine. Segments that wait for
+# an engine get it in the order in which they play.
+ENGINE_CONCURRENCY = {
+    'edge': 4,
+    'piper': 1,
+    'sapi': 2,
+}
+# Synthesis of the next text starts once the audio queued ahead of it plays
+# for less than its engine needs to stay ahead of playback (estimated from
+# the measured real-time factor and first chunk latency) times
+# PREFETCH_SAFETY, plus PREFETCH_MARGIN seconds. See schedule.py.
+PREFETCH_SAFETY = 1.5
+PREFETCH_MARGIN = 2.0
+# Upper bound on the number of items waiting in the output queue.
+PREFETCH_MAX_ITEMS = 20
+# Bytes of audio that all items together may hold in memory, including
+# the last BROADCAST_HISTORY played ones. No new segments are rendered
+# while it is exceeded, except for the item that is playing. 0 disables the
+# limit.
+AUDIO_BUDGET = 256 * 1024 * 1024
+# Small chunks from engines are coalesced into blocks of up to this size.
+AUDIO_BLOCK_SIZE = 64 * 1024
+# Hedged synthesis per language (or 'default'): if the engine has not
+# produced the first chunk of a segment within the given seconds, the
+# fallback engine renders it too and whichever streams first is used, e.g.
+# {'fa': ('piper', 2.0)}. Fallback engines are warmed up with ENGINES.
+# Hedges need ffmpeg, since engines may produce audio in other formats.
+HEDGES: dict[str, tuple[str, float]] = {}
+# Texts are split into sentence-based segments that are synthesized ahead
+# while earlier ones are playing. The first segment is kept short to reduce
+# the time to first audio.
+SEGMENT_FIRST_MAX_CHARS = 150
+SEGMENT_MAX_CHARS = 600
+# Number of segments rendered ahead of the one being streamed.
+SEGMENT_LOOKAHEAD = 2
+# Number of websocket connections to the Edge TTS service that are kept open
+# and ready for the next request. Set it to 0 to open a new connection for
+# each request instead.
+EDGE_WARM_CONNECTIONS = 2
+# Idle connections older than this many seconds are not reused.
+EDGE_CONNECTION_MAX_IDLE = 30.0
+# None uses the Edge TTS service. Can be pointed to a local stand-in server.
+EDGE_WSS_URL: str | None = None
+# Number of threads that run Piper inference.
+PIPER_THREADS = 1
+# Number of synthesized Piper chunks that may wait for the event loop.
+PIPER_CHANNEL_SIZE = 4
+# Piper model file (in engines/piper/voices) and length_scale per language.
+# https://github.com/OHF-Voice/piper1-gpl/blob/main/docs/API_PYTHON.md
+PIPER_VOICES: dict[str, tuple[str, float | None]] = {
+    'fa': ('fa_IR-gyro-medium.onnx', 0.8),
+    'default': ('en_US-hfc_male-medium.onnx', None),
+}
+# Piper voices are loaded on first use and unloaded after being idle for this
+# many seconds. Set it to 0 to keep loaded voices in memory.
+PIPER_IDLE_UNLOAD = 600.0
+# Upper limit for the total size of loaded Piper models, in bytes. Idle
+# voices are unloaded to make room for new ones. 0 means no limit.
+PIPER_MAX_MEMORY = 0
+# Number of threads, each with its own SAPI voice, that render SAPI audio.
+SAPI_THREADS = 2
+# Number of rendered SAPI sentences that may wait for the event loop.
+SAPI_CHANNEL_SIZE = 4
+# PCM audio (Piper, SAPI) can be post-processed chunk by chunk, if numpy is
+# installed (pip install edge-tts-server[dsp]). See dsp.py. All of it is
+# off by default.
+# Playback speed, without changing the pitch; about 0.5 to 2. 1.0 keeps it.
+DSP_SPEED = 1.0
+# Silence at the start and end is cut and longer pauses are shortened to this
+# many seconds, e.g. 0.5. None keeps silence as it is.
+DSP_MAX_PAUSE: float | None = None
+# Audio quieter than this (RMS, in dBFS) counts as silence.
+DSP_SILENCE_DB = -45.0
+# Speech is scaled towards this RMS level (dBFS), e.g. -20.0, so that all
+# engines are about as loud. None keeps the volume as it is.
+DSP_LOUDNESS: float | None = None
+# Number of recent items whose audio is kept for listeners that are behind.
+BROADCAST_HISTORY = 3
+# Path to ffmpeg, used to send PCM audio compressed (e.g. /audio?format=opus
+# or format=mp3) to listeners that are not on localhost. None searches PATH.
+FFMPEG: str | None = None
+# Number of bytes read from the encoder at a time.
+ENCODE_READ_SIZE = 16 * 1024
+# Start without the Qt clipboard monitor; texts are only accepted through
+# POST /texts. Same as passing --headless.
+HEADLESS = False
+# Largest message, e.g. a copied text with its trace metadata, in bytes that
+# the server accepts from the Qt process; larger texts are skipped.
+IPC_MAX_FRAME_SIZE = 1024 * 1024
+# Engines are imported in the background after the server starts and
+# synthesize these texts once per language in ENGINES, so that the first
+# real text does not pay for loading models or opening connections. Set it to
+# {} to only import the engines.
+WARMUP_TEXTS = {
+    'fa': 'سلام.',
+    'default': 'Hello.',
+}
+# Profile startup until warm-up is done, log the slowest calls and save the
+# stats to this file (readable with pstats). Same as --profile-startup, which
+# saves to startup.prof.
+PROFILE_STARTUP: Path | None = None
+# Number of recent item traces served by /traces.
+TRACE_HISTORY = 100
+# Finished traces are appended to this JSON lines file. None disables it.
+TRACE_FILE: Path | None = None
+# Timing of the fake engine that `python -m cliptalk.benchmark` uses:
+# seconds until the first chunk, seconds between chunks, bytes per chunk
+# and bytes of 16 kHz 16-bit PCM per character of text (~15 chars/s).
+FAKE_LATENCY = 0.2
+FAKE_CHUNK_INTERVAL = 0.02
+FAKE_CHUNK_SIZE = 4096
+FAKE_BYTES_PER_CHAR = 2 * 16000 // 15
+# The clipboard monitor ignores texts that it has seen in the last
+# DEDUP_WINDOW seconds, remembering at most DEDUP_HISTORY of them.
+DEDUP_WINDOW = 30.0
+DEDUP_HISTORY = 256
+# Items whose text was played in the last REPLAY_WINDOW seconds are flagged
+# as replays to listeners.
+REPLAY_WINDOW = 600.0
+# Queue sizes and synthesis progress are pushed to listeners at most once
+# per this many seconds.
+STATUS_INTERVAL = 0.25
+# An engine whose last HEALTH_FAILURES syntheses failed, or took more than
+# HEALTH_SLOW_SECONDS to their first chunk, is taken out of service and its
+# languages go to FALLBACK_ENGINES[engine] meanwhile. After HEALTH_COOLDOWN
+# seconds it is probed in the background with WARMUP_TEXTS; the cool-down
+# doubles, up to HEALTH_MAX_COOLDOWN, while probes fail.
+HEALTH_FAILURES = 3
+HEALTH_SLOW_SECONDS = 10.0
+HEALTH_COOLDOWN = 30.0
+HEALTH_MAX_COOLDOWN = 300.0
+FALLBACK_ENGINES = {
+    'edge': 'piper',
+}
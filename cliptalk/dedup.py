@@ -0,0 +1,64 @@
+"""
+Recognize texts that were seen before.
+
+Texts are compared by a fingerprint of their normalized form (case folded,
+with runs of white space collapsed), so the same paragraph copied from two
+places is still a repeat. RecentIndex keeps fingerprints in the order they
+were last seen, so lookups are O(1) and the oldest entries are dropped once
+they are older than its window or the index is full.
+
+The Qt process ignores texts that were copied in the last DEDUP_WINDOW
+seconds. The server collapses texts that are still waiting in in_q or out_q
+into the waiting item, and flags texts played in the last REPLAY_WINDOW
+seconds as replays.
+"""
+
+from collections import OrderedDict
+from hashlib import blake2b
+from time import monotonic
+
+from cliptalk import config
+
+
+def fingerprint(text: str) -> bytes:
+    normalized = ' '.join(text.casefold().split())
+    return blake2b(normalized.encode(), digest_size=16).digest()
+
+
+class RecentIndex:
+    def __init__(self, maxsize: int, window: float):
+        self.maxsize = maxsize
+        self.window = window
+        # fingerprint -> monotonic time it was last seen, oldest first
+        self._seen: OrderedDict[bytes, float] = OrderedDict()
+
+    def _expire(self, now: float):
+        seen = self._seen
+        while seen and (
+            len(seen) > self.maxsize
+            or next(iter(seen.values())) < now - self.window
+        ):
+            seen.popitem(last=False)
+
+    def seen(self, fp: bytes) -> bool:
+        """Record `fp` and return whether it was seen within the window."""
+        now = monotonic()
+        self._expire(now)
+        seen = self._seen
+        found = fp in seen
+        seen[fp] = now
+        seen.move_to_end(fp)
+        self._expire(now)
+        return found
+
+
+# fingerprint -> trace ID of texts that are in in_q or out_q
+pending: dict[bytes, str] = {}
+played = RecentIndex(config.DEDUP_HISTORY, config.REPLAY_WINDOW)
+
+
+def announced(text: str) -> bool:
+    """Forget `text` as pending and return whether it is a replay."""
+    fp = fingerprint(text)
+    pending.pop(fp, None)
+    return played.seen(fp)
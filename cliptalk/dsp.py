@@ -0,0 +1,268 @@
+"""
+Post-process the PCM audio of WAV engines with NumPy, chunk by chunk.
+
+Piper and SAPI only have coarse rate settings of their own, and engines
+speak at different volumes. A Processor sits between synthesis and an
+item's AudioBuffer and, in this order:
+
+- cuts silence at the start and end and shortens pauses longer than
+  DSP_MAX_PAUSE, which shortens listening time;
+- changes the speed by DSP_SPEED without changing the pitch, with WSOLA
+  (waveform similarity overlap-add);
+- scales speech towards DSP_LOUDNESS, so that all engines sound equally
+  loud.
+
+Each stage only holds back a few windows of audio (at most DSP_MAX_PAUSE
+while in a pause), so audio is passed on while it is synthesized and a whole
+utterance is never held in memory. MP3 from Edge is passed on as it is.
+numpy is an optional dependency; without it audio is not post-processed.
+"""
+
+from asyncio import to_thread
+
+import numpy as np
+
+from cliptalk import AudioSink, config, wav
+
+# seconds per window of the silence and loudness stages
+_WINDOW = 0.01
+# seconds per synthesis hop of time stretching; its windows are twice as long
+_HOP = 0.015
+# loudness is followed over about this many seconds of speech, but louder
+# speech is caught up with within _ATTACK_SECONDS, so that it does not clip
+_LOUDNESS_SECONDS = 3.0
+_ATTACK_SECONDS = 0.2
+# limit on the amplification of quiet engines (20 dB)
+_MAX_GAIN = 10.0
+
+# engine -> mean square of its speech, so that items start at the right gain
+_levels: dict[str, float] = {}
+
+
+def enabled() -> bool:
+    return (
+        config.DSP_SPEED != 1.0
+        or config.DSP_MAX_PAUSE is not None
+        or config.DSP_LOUDNESS is not None
+    )
+
+
+def _empty(x: np.ndarray) -> np.ndarray:
+    return x[:0]
+
+
+class _Silence:
+    """Cut leading and trailing silence and shorten long pauses."""
+
+    def __init__(self, rate: int, channels: int, max_pause: float):
+        self.window = max(round(rate * _WINDOW), 1)
+        self.max_pause = round(max_pause / _WINDOW)
+        self.threshold = 10 ** (config.DSP_SILENCE_DB / 20)
+        self.rest = np.zeros((0, channels), np.float32)
+        # silence after speech, kept in case more speech follows
+        self.held: list[np.ndarray] = []
+        self.held_windows = 0
+        self.speech = False
+
+    def process(self, x: np.ndarray, last: bool) -> np.ndarray:
+        x = np.concatenate((self.rest, x))
+        n = len(x) // self.window * self.window
+        self.rest = x[n:]
+        windows = x[:n].reshape(-1, self.window, x.shape[1])
+        silent = np.sqrt((windows**2).mean(axis=(1, 2))) < self.threshold
+        out: list[np.ndarray] = []
+        starts = [0, *(np.flatnonzero(np.diff(silent)) + 1)]
+        for start, end in zip(starts, [*starts[1:], len(silent)]):
+            if start == end:
+                continue
+            if not silent[start]:
+                out += self.held
+                out.append(windows[start:end].reshape(-1, x.shape[1]))
+                self.held = []
+                self.held_windows = 0
+                self.speech = True
+            elif self.speech:
+                keep = min(end - start, self.max_pause - self.held_windows)
+                if keep > 0:
+                    run = windows[start : start + keep]
+                    self.held.append(run.reshape(-1, x.shape[1]))
+                    self.held_windows += keep
+        if last and self.speech and not self.held:
+            out.append(self.rest)
+        return np.concatenate(out) if out else _empty(x)
+
+
+class _Stretch:
+    """Change the speed by `speed` without changing the pitch (WSOLA)."""
+
+    def __init__(self, rate: int, channels: int, speed: float):
+        hop = self.hop = max(round(rate * _HOP), 2)
+        self.size = 2 * hop
+        self.tolerance = hop // 2
+        self.analysis_hop = hop * speed
+        # periodic Hann windows that overlap by half sum up to one
+        self.hann = np.hanning(self.size + 1)[:-1, None].astype(np.float32)
+        self.buf = np.zeros((0, channels), np.float32)
+        # absolute index of buf[0] and number of samples received
+        self.start = 0
+        self.received = 0
+        # nominal position of the next frame in the input
+        self.pos = 0.0
+        # what naturally follows the previous frame, as a mono signal
+        self.template: np.ndarray | None = None
+        # second half of the previous frame, waiting to be overlapped
+        self.tail = np.zeros((hop, channels), np.float32)
+
+    def process(self, x: np.ndarray, last: bool) -> np.ndarray:
+        hop, size, tolerance = self.hop, self.size, self.tolerance
+        self.received += len(x)
+        buf = np.concatenate((self.buf, x))
+        if last:  # let the last frames run past the end
+            buf = np.concatenate(
+                (
+                    buf,
+                    np.zeros(
+                        (size + hop + 2 * tolerance, x.shape[1]), np.float32
+                    ),
+                )
+            )
+        out: list[np.ndarray] = []
+        while True:
+            p = round(self.pos)
+            if p + tolerance + size + hop > self.start + len(buf):
+                break
+            if last and p >= self.received:
+                break
+            if self.template is None:
+                q = p
+            else:
+                lo = max(p - tolerance, self.start)
+                region = buf[
+                    lo - self.start : p + tolerance + size - self.start
+                ]
+                similarity = np.correlate(
+                    region.mean(axis=1), self.template, 'valid'
+                )
+                q = lo + int(np.argmax(similarity))
+            i = q - self.start
+            frame = buf[i : i + size] * self.hann
+            frame[:hop] += self.tail
+            out.append(frame[:hop])
+            self.tail = frame[hop:]
+            self.template = buf[i + hop : i + hop + size].mean(axis=1)
+            self.pos += self.analysis_hop
+        if last:
+            out.append(self.tail)
+        cut = max(min(round(self.pos) - tolerance, self.received), self.start)
+        self.buf = buf[cut - self.start : self.received - self.start]
+        self.start = cut
+        return np.concatenate(out) if out else _empty(x)
+
+
+class _Loudness:
+    """Scale speech towards the DSP_LOUDNESS level."""
+
+    def __init__(self, rate: int, level: float | None):
+        self.window = max(round(rate * _WINDOW), 1)
+        self.target = 10 ** (config.DSP_LOUDNESS / 20)  # type: ignore
+        self.threshold = 10 ** (config.DSP_SILENCE_DB / 10)
+        # weight of a window of speech in the level
+        self.release = _WINDOW / _LOUDNESS_SECONDS
+        self.attack = _WINDOW / _ATTACK_SECONDS
+        # mean square of speech so far
+        self.level = level
+        self.gain = self._gain()
+
+    def _gain(self) -> float:
+        if not self.level:
+            return 1.0
+        return min(self.target / self.level**0.5, _MAX_GAIN)
+
+    def process(self, x: np.ndarray, last: bool) -> np.ndarray:
+        if not len(x):
+            return x
+        n = len(x) // self.window * self.window
+        squares = (x[:n].reshape(-1, self.window * x.shape[1]) ** 2).mean(1)
+        if len(speech := squares[squares >= self.threshold]):
+            mean = float(speech.mean())
+            if self.level is None:
+                self.level = mean
+            else:
+                alpha = self.attack if mean > self.level else self.release
+                self.level += (mean - self.level) * (
+                    1 - (1 - alpha) ** len(speech)
+                )
+        # never amplify peaks beyond full scale
+        gain = min(self._gain(), 1 / max(float(np.abs(x).max()), 1e-9))
+        # ramp to the new gain over the chunk to avoid steps
+        ramp = np.linspace(self.gain, gain, len(x), dtype=np.float32)
+        self.gain = gain
+        return x * ramp[:, None]
+
+
+class Processor:
+    """Forward puts to an AudioSink, post-processing 16-bit PCM on the way."""
+
+    def __init__(self, audio_q: AudioSink, engine: str):
+        self.audio_q = audio_q
+        self.engine = engine
+        self.pending = b''
+        # None until the format is known, empty to pass audio on as it is
+        self.stages: list[_Silence | _Stretch | _Loudness] | None = None
+        self.loudness: _Loudness | None = None
+        self.channels = 1
+
+    def _start(self, header: bytes):
+        self.stages = []
+        if (params := wav.params(header)) is None or params[2] != 2:
+            return
+        rate, self.channels, _ = params
+        if (max_pause := config.DSP_MAX_PAUSE) is not None:
+            self.stages.append(_Silence(rate, self.channels, max_pause))
+        if config.DSP_SPEED != 1.0:
+            self.stages.append(_Stretch(rate, self.channels, config.DSP_SPEED))
+        if config.DSP_LOUDNESS is not None:
+            self.loudness = _Loudness(rate, _levels.get(self.engine))
+            self.stages.append(self.loudness)
+
+    def _process(self, data: bytes, last: bool) -> bytes:
+        frame = 2 * self.channels
+        data = self.pending + data
+        size = len(data) // frame * frame
+        self.pending = data[size:]
+        x = np.frombuffer(data[:size], '<i2').reshape(-1, self.channels)
+        x = x.astype(np.float32) / 32768
+        for stage in self.stages:  # type: ignore
+            x = stage.process(x, last)
+        return (np.clip(x, -1, 1) * 32767).astype('<i2').tobytes()
+
+    async def put(self, data: bytes):
+        if self.stages is None:
+            self.pending += data
+            if (size := wav.header_size(self.pending)) is None:
+                return
+            header, data = self.pending[:size], self.pending[size:]
+            self.pending = b''
+            self._start(header)
+            if header:
+                await self.audio_q.put(header)
+        if not self.stages:
+            await self.audio_q.put(data)
+            return
+        if not data:
+            return
+        # keeps the event loop free while longer chunks are processed
+        if processed := await to_thread(self._process, data, False):
+            await self.audio_q.put(processed)
+
+    async def flush(self):
+        """Pass on the audio that is held back, at the end of the item."""
+        if not self.stages:
+            if pending := self.pending:
+                self.pending = b''
+                await self.audio_q.put(pending)
+            return
+        if processed := await to_thread(self._process, b'', True):
+            await self.audio_q.put(processed)
+        if (loudness := self.loudness) is not None and loudness.level:
+            _levels[self.engine] = loudness.level
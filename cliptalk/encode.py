@@ -0,0 +1,135 @@
+"""
+Transcode the PCM audio of WAV engines to a compressed streaming format.
+
+Encoding is done chunk by chunk by an ffmpeg subprocess, so the first
+encoded bytes are sent while the rest of the audio is still being
+synthesized. If ffmpeg cannot be found, audio is served as WAV.
+
+`transcode` also converts whole segments, when the engines of a mixed-script
+text produce audio in different formats.
+"""
+
+import shutil
+from asyncio import create_subprocess_exec, create_task
+from asyncio.subprocess import DEVNULL, PIPE
+from collections.abc import AsyncIterator
+from ipaddress import ip_address
+
+from aiohttp.web import Request
+
+from cliptalk import AudioBuffer, config, logger
+
+# format -> (content type, ffmpeg codec options, ffmpeg container)
+FORMATS = {
+    'opus': (
+        'audio/ogg',
+        ['-c:a', 'libopus', '-b:a', '32k', '-page_duration', '100000'],
+        'ogg',
+    ),
+    'mp3': ('audio/mpeg', ['-c:a', 'libmp3lame', '-b:a', '48k'], 'mp3'),
+}
+
+ffmpeg = config.FFMPEG or shutil.which('ffmpeg')
+if ffmpeg is None:
+    logger.info('ffmpeg not found; PCM audio will only be served as WAV.')
+
+
+def _is_local(request: Request) -> bool:
+    try:
+        return ip_address(request.remote or '').is_loopback
+    except ValueError:
+        return False
+
+
+def negotiate(request: Request) -> str | None:
+    """
+    Return the compressed format requested for `request`, or None for WAV.
+
+    An explicit `format` query parameter wins. Otherwise the Accept header
+    is used, but only for remote listeners; on localhost bandwidth is free
+    and encoding would only cost CPU.
+    """
+    if ffmpeg is None:
+        return None
+    requested = request.query.get('format')
+    if requested is not None:
+        return requested if requested in FORMATS else None
+    if _is_local(request):
+        return None
+    accept = request.headers.get('Accept', '')
+    wav_at = accept.find('audio/wav')
+    for name, (mime, *_) in FORMATS.items():
+        at = accept.find(mime)
+        if at != -1 and (wav_at == -1 or at < wav_at):
+            return name
+    return None
+
+
+def content_type(name: str) -> str:
+    return FORMATS[name][0]
+
+
+async def encode(buffer: AudioBuffer, name: str) -> AsyncIterator[bytes]:
+    _, options, container = FORMATS[name]
+    process = await create_subprocess_exec(
+        ffmpeg,  # type: ignore
+        *('-loglevel', 'error', '-f', 'wav', '-i', 'pipe:0'),
+        *options,
+        *('-flush_packets', '1', '-f', container, 'pipe:1'),
+        stdin=PIPE,
+        stdout=PIPE,
+        stderr=DEVNULL,
+    )
+    stdin = process.stdin
+    stdout = process.stdout
+    assert stdin is not None and stdout is not None
+
+    async def feed():
+        try:
+            async for chunk in buffer.read():
+                stdin.write(chunk)
+                await stdin.drain()
+        finally:
+            stdin.close()
+
+    feeder = create_task(feed())
+    try:
+        while data := await stdout.read(config.ENCODE_READ_SIZE):
+            yield data
+        await feeder
+    finally:
+        feeder.cancel()
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+
+async def transcode(
+    data: bytes, options: list[str], container: str
+) -> bytes | None:
+    """Convert a complete audio file; return None if ffmpeg is unusable."""
+    if ffmpeg is None:
+        return None
+    try:
+        process = await create_subprocess_exec(
+            ffmpeg,
+            *('-loglevel', 'error', '-i', 'pipe:0'),
+            *options,
+            *('-f', container, 'pipe:1'),
+            stdin=PIPE,
+            stdout=PIPE,
+            stderr=DEVNULL,
+        )
+    except OSError as e:
+        logger.warning(f'Could not run ffmpeg: {e!r}')
+        return None
+    try:
+        output, _ = await process.communicate(data)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    if process.returncode:
+        logger.warning(f'ffmpeg exited with {process.returncode}')
+        return None
+    return output
@@ -1,7 +1,79 @@
-from re import compile as rc
+from asyncio import Queue, get_running_loop, run_coroutine_threadsafe
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterable
+from concurrent.futures import Executor
+from contextvars import ContextVar
 
-_fa_search = rc('[\u0600-\u06ff]').search
+from cliptalk import AudioSink
 
+# Engines that know where words end append (end of the word in the text,
+# end of its audio in seconds) here while synthesizing, if a list is set.
+# It lets a failed synthesis resume after the last word that was sent.
+word_boundaries: ContextVar[list[tuple[int, float]] | None] = ContextVar(
+    'word_boundaries', default=None
+)
 
-def detect_lang(text: str) -> str:
-    return 'fa' if _fa_search(text) else 'en'
+
+def import_engine(
+    engine: str,
+) -> tuple[Callable[[str, str, AudioSink], Awaitable], Callable[[str], str]]:
+    """
+    Import an engine and return its `prefetch_audio` and `voice_id`.
+
+    piper engine uses a lot more memory, but is usually more responsive.
+    edge engine uses the Microsoft Edge tts servers.
+    sapi uses Microsoft Speech API (SAPI). It has limited features,
+        but is usually the most responsive one.
+    fake engine streams silence; it is used by cliptalk.benchmark.
+    """
+    match engine:
+        case 'edge':
+            from cliptalk.engines.edge import prefetch_audio, voice_id
+
+        case 'sapi':
+            from cliptalk.engines.sapi import prefetch_audio, voice_id
+
+        case 'piper':
+            from cliptalk.engines.piper import prefetch_audio, voice_id
+
+        case 'fake':
+            from cliptalk.engines.fake import prefetch_audio, voice_id
+
+        case _:
+            raise ValueError('unknown engine')
+
+    return prefetch_audio, voice_id
+
+
+async def iterate_in_executor[T](
+    executor: Executor, iterable: Callable[[], Iterable[T]], maxsize: int
+) -> AsyncIterator[T]:
+    """
+    Iterate `iterable()` in `executor` and yield its items on the event loop.
+
+    Items are handed back through a bounded channel, so the worker thread
+    pauses while the consumer is behind. Use it with `aclosing` so that when
+    the consumer stops early (e.g. because its audio_q was shut down), the
+    channel is shut down at once, which stops the worker at its next item.
+    """
+    loop = get_running_loop()
+    channel: Queue[tuple[T] | None] = Queue(maxsize)
+
+    def put(item: tuple[T] | None):
+        # blocks the worker thread while the channel is full
+        run_coroutine_threadsafe(channel.put(item), loop).result()
+
+    def produce():
+        try:
+            for item in iterable():
+                put((item,))
+        finally:
+            put(None)
+
+    future = loop.run_in_executor(executor, produce)
+    try:
+        while (item := await channel.get()) is not None:
+            yield item[0]
+        await future  # re-raise errors of the worker
+    finally:
+        channel.shutdown(immediate=True)
+        future.cancel()
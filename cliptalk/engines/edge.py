@@ -1,6 +1,50 @@
+import json
+import ssl
+from asyncio import Task, create_task, gather, timeout
+from collections import deque
+from collections.abc import AsyncIterator
+from time import monotonic
+from xml.sax.saxutils import escape
+
+import certifi
+from aiohttp import (
+    ClientResponseError,
+    ClientSession,
+    ClientTimeout,
+    ClientWebSocketResponse,
+    WSMsgType,
+)
 from edge_tts import Communicate, VoicesManager
+from edge_tts.exceptions import (
+    NoAudioReceived,
+    UnexpectedResponse,
+    WebSocketError,
+)
+
+from cliptalk import AudioSink, config, logger
+from cliptalk.engines import word_boundaries
+from cliptalk.schedule import MP3_BYTE_RATE
 
-from cliptalk import AudioQ
+# The connection pool runs the Edge protocol with internals of edge_tts that
+# may change in any release. Without them, Communicate is used instead.
+try:
+    from edge_tts.communicate import (
+        connect_id,
+        date_to_string,
+        get_headers_and_data,
+        mkssml,
+        remove_incompatible_characters,
+        split_text_by_byte_length,
+        ssml_headers_plus_data,
+    )
+    from edge_tts.constants import SEC_MS_GEC_VERSION, WSS_HEADERS, WSS_URL
+    from edge_tts.data_classes import TTSConfig
+    from edge_tts.drm import DRM
+except ImportError as e:
+    pooling = False
+    logger.warning(f'Edge connections will not be pooled: {e!r}')
+else:
+    pooling = True
 
 # See set_voice_names for how to retrieve and search available voices
 fa_voice: str = (
@@ -10,6 +54,9 @@ en_voice: str = (
     'Microsoft Server Speech Text to Speech Voice (en-US, AvaNeural)'
 )
 
+CONNECT_TIMEOUT = 5
+RECEIVE_TIMEOUT = 20
+
 
 async def set_voice_names():
     global fa_voice, en_voice
@@ -18,12 +65,264 @@ async def set_voice_names():
     en_voice = voice_manager.find(ShortName='en-US-AvaNeural')[0]['Name']  # type: ignore
 
 
-async def prefetch_audio(text: str, lang: str, audio_q: AudioQ):
+def voice_id(lang: str) -> str:
+    return fa_voice if lang == 'fa' else en_voice
+
+
+class ConnectionPool:
+    """
+    Keep websocket connections to the Edge TTS service open and ready.
+
+    A new connection costs a TLS and a websocket handshake before the first
+    audio byte can arrive. The pool opens connections ahead of time and takes
+    connections back after a complete turn, so that most requests start on an
+    already-open socket. Idle connections are dropped after `max_idle`
+    seconds since the service closes them eventually. `url` defaults to the
+    Edge TTS service.
+    """
+
+    def __init__(self, url: str | None, size: int, max_idle: float):
+        self.url = url
+        self.size = size
+        self.max_idle = max_idle
+        self.idle: deque[tuple[float, ClientWebSocketResponse]] = deque()
+        self.opening = 0
+        self._tasks: set[Task] = set()
+        self._session: ClientSession | None = None
+        self._ssl = ssl.create_default_context(cafile=certifi.where())
+
+    def _get_session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                trust_env=True,
+                timeout=ClientTimeout(
+                    total=None, connect=None, sock_connect=CONNECT_TIMEOUT
+                ),
+            )
+        return self._session
+
+    async def _connect(self) -> ClientWebSocketResponse:
+        url = self.url or WSS_URL
+        # sock_connect does not cover a server that never answers the
+        # websocket upgrade
+        async with timeout(CONNECT_TIMEOUT):
+            return await self._get_session().ws_connect(
+                f'{url}&ConnectionId={connect_id()}'
+                f'&Sec-MS-GEC={DRM.generate_sec_ms_gec()}'
+                f'&Sec-MS-GEC-Version={SEC_MS_GEC_VERSION}',
+                compress=15,
+                headers=DRM.headers_with_muid(WSS_HEADERS),
+                ssl=self._ssl,
+            )
+
+    async def open(self) -> ClientWebSocketResponse:
+        try:
+            ws = await self._connect()
+        except ClientResponseError as e:
+            if e.status != 403:
+                raise
+            # adjusts the clock skew used to generate Sec-MS-GEC
+            DRM.handle_client_response_error(e)
+            ws = await self._connect()
+        await ws.send_str(
+            f'X-Timestamp:{date_to_string()}\r\n'
+            'Content-Type:application/json; charset=utf-8\r\n'
+            'Path:speech.config\r\n\r\n'
+            '{"context":{"synthesis":{"audio":{"metadataoptions":{'
+            '"sentenceBoundaryEnabled":"false",'
+            '"wordBoundaryEnabled":"true"},'
+            '"outputFormat":"audio-24khz-48kbitrate-mono-mp3"'
+            '}}}}\r\n'
+        )
+        return ws
+
+    async def _open_idle(self):
+        try:
+            ws = await self.open()
+        except Exception as e:
+            logger.debug(f'Could not pre-open Edge connection: {e!r}')
+            return
+        finally:
+            self.opening -= 1
+        self.idle.append((monotonic(), ws))
+
+    def fill(self):
+        """Start opening connections until `size` are ready or opening."""
+        while len(self.idle) + self.opening < self.size:
+            self.opening += 1
+            task = create_task(self._open_idle())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def acquire(self) -> tuple[ClientWebSocketResponse, bool]:
+        """Return a connection and whether it was already open."""
+        now = monotonic()
+        ws = None
+        while self.idle:
+            since, idle_ws = self.idle.popleft()
+            if idle_ws.closed or now - since > self.max_idle:
+                await idle_ws.close()
+                continue
+            ws = idle_ws
+            break
+        self.fill()
+        if ws is not None:
+            return ws, True
+        return await self.open(), False
+
+    async def release(self, ws: ClientWebSocketResponse):
+        """Return a connection that has completed its turn to the pool."""
+        if ws.closed or len(self.idle) >= self.size:
+            await ws.close()
+            return
+        self.idle.append((monotonic(), ws))
+
+    async def close(self):
+        """Close all connections and the session, on shutdown."""
+        tasks = [*self._tasks]
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+        while self.idle:
+            _, ws = self.idle.popleft()
+            await ws.close()
+        if self._session is not None:
+            await self._session.close()
+
+
+pool = ConnectionPool(
+    config.EDGE_WSS_URL,
+    config.EDGE_WARM_CONNECTIONS,
+    config.EDGE_CONNECTION_MAX_IDLE,
+)
+
+
+class _Words:
+    """Report where the words of `text` end to word_boundaries, if set."""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.boundaries = word_boundaries.get()
+        # end of the last word found in text
+        self.pos = 0
+        # seconds of audio before the current turn
+        self.offset = 0.0
+
+    def add(self, word: str, end: int):
+        """Record `word`, whose audio ends at `end` (in 100ns ticks)."""
+        if self.boundaries is None:
+            return
+        if (start := self.text.find(word, self.pos)) == -1:
+            return
+        self.pos = start + len(word)
+        self.boundaries.append((self.pos, self.offset + end / 10_000_000))
+
+    def mark(self) -> tuple[int, int]:
+        return self.pos, len(self.boundaries or ())
+
+    def rewind(self, mark: tuple[int, int]):
+        self.pos, count = mark
+        if self.boundaries is not None:
+            del self.boundaries[count:]
+
+
+async def _receive_audio(
+    ws: ClientWebSocketResponse, ssml: str, words: _Words
+) -> AsyncIterator[bytes]:
+    """Run one SSML turn on `ws` and yield its audio."""
+    await ws.send_str(
+        ssml_headers_plus_data(connect_id(), date_to_string(), ssml)
+    )
+    while True:
+        received = await ws.receive(timeout=RECEIVE_TIMEOUT)
+        if received.type == WSMsgType.TEXT:
+            encoded_data: bytes = received.data.encode()
+            parameters, data = get_headers_and_data(
+                encoded_data, encoded_data.find(b'\r\n\r\n')
+            )
+            path = parameters.get(b'Path')
+            if path == b'turn.end':
+                return
+            if path == b'audio.metadata':
+                for meta in json.loads(data)['Metadata']:
+                    if meta['Type'] == 'WordBoundary':
+                        meta = meta['Data']
+                        words.add(
+                            meta['text']['Text'],
+                            meta['Offset'] + meta['Duration'],
+                        )
+        elif received.type == WSMsgType.BINARY:
+            header_length = int.from_bytes(received.data[:2], 'big')
+            if header_length > len(received.data):
+                raise UnexpectedResponse('Invalid binary header length.')
+            parameters, data = get_headers_and_data(
+                received.data, header_length
+            )
+            if parameters.get(b'Path') == b'audio' and data:
+                yield data
+        else:
+            raise WebSocketError(f'Unexpected websocket message: {received}')
+
+
+async def _pooled_prefetch_audio(text: str, voice: str, audio_q: AudioSink):
+    tts_config = TTSConfig(voice, '+0%', '+0%', '+0Hz', 'WordBoundary')
+    words = _Words(text)
+    total = 0
+    for escaped_text in split_text_by_byte_length(
+        escape(remove_incompatible_characters(text)), 4096
+    ):
+        ssml = mkssml(tts_config, escaped_text)
+        started = monotonic()
+        ws, warm = await pool.acquire()
+        words.offset = total / MP3_BYTE_RATE
+        turn_start = words.mark()
+        while True:
+            received = 0
+            # forget the words of a failed try of this turn
+            words.rewind(turn_start)
+            try:
+                async for data in _receive_audio(ws, ssml, words):
+                    if not received:
+                        logger.debug(
+                            f'Edge first audio byte after '
+                            f'{(monotonic() - started) * 1000:.0f}ms '
+                            f'({"warm" if warm else "new"} connection)'
+                        )
+                    received += len(data)
+                    await audio_q.put(data)
+            except BaseException as e:
+                await ws.close()
+                # The service may have closed an idle connection in the
+                # meantime. Nothing was sent yet, so redo the turn.
+                if isinstance(e, Exception) and warm and not received:
+                    ws, warm = await pool.open(), False
+                    continue
+                raise
+            break
+        if not received:
+            await ws.close()
+            raise NoAudioReceived('No audio was received.')
+        total += received
+        await pool.release(ws)
+
+
+async def prefetch_audio(text: str, lang: str, audio_q: AudioSink):
     """Prefetch audio for all texts in the queue."""
-    is_fa = lang == 'fa'
-    voice = fa_voice if is_fa else en_voice
+    voice = voice_id(lang)
+    if pooling and config.EDGE_WARM_CONNECTIONS > 0:
+        await _pooled_prefetch_audio(text, voice, audio_q)
+        return
+    words = _Words(text)
     async for message in Communicate(
-        text, voice, connect_timeout=5, receive_timeout=20
+        text,
+        voice,
+        connect_timeout=CONNECT_TIMEOUT,
+        receive_timeout=RECEIVE_TIMEOUT,
     ).stream():
         if message['type'] == 'audio':
             await audio_q.put(message['data'])  # type: ignore
+        elif message['type'] == 'WordBoundary':
+            words.add(
+                message['text'],  # type: ignore
+                message['offset'] + message['duration'],  # type: ignore
+            )
@@ -0,0 +1,32 @@
+"""
+Deterministic stand-in engine for benchmarks.
+
+It streams silent 16-bit PCM after FAKE_LATENCY seconds, in chunks of
+FAKE_CHUNK_SIZE bytes every FAKE_CHUNK_INTERVAL seconds. The amount of audio
+is proportional to the length of the text, so the pipeline sees realistic
+sizes without any network or CPU cost.
+"""
+
+from asyncio import sleep
+
+from cliptalk import AudioSink, config, wav
+
+SAMPLE_RATE = 16000
+CHANNELS = 1
+SAMPLE_WIDTH = 2
+
+
+def voice_id(lang: str) -> str:
+    return f'fake:{lang}'
+
+
+async def prefetch_audio(text: str, lang: str, audio_q: AudioSink):
+    await sleep(config.FAKE_LATENCY)
+    await audio_q.put(wav.header(SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH))
+    remaining = len(text) * config.FAKE_BYTES_PER_CHAR
+    chunk = bytes(config.FAKE_CHUNK_SIZE)
+    while remaining > 0:
+        await audio_q.put(chunk[:remaining])
+        remaining -= len(chunk)
+        if remaining > 0:
+            await sleep(config.FAKE_CHUNK_INTERVAL)
@@ -1,68 +1,140 @@
-import wave
-from asyncio import Queue, sleep
-from collections.abc import Iterable
-from io import BytesIO
+from asyncio import Lock, Task, create_task, sleep, to_thread
+from collections.abc import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, asynccontextmanager
+from functools import partial
 from pathlib import Path
+from time import monotonic
 
-from piper import AudioChunk, PiperVoice, SynthesisConfig
+from piper import PiperVoice, SynthesisConfig
 
-from cliptalk import AudioQ, logger
+from cliptalk import AudioSink, config, logger, wav
+from cliptalk.engines import iterate_in_executor
 
 THIS_DIR = Path(__file__).parent
-en_voice = PiperVoice.load(THIS_DIR / 'voices/en_US-hfc_male-medium.onnx')
-fa_voice = PiperVoice.load(THIS_DIR / 'voices/fa_IR-gyro-medium.onnx')
 
-# https://github.com/OHF-Voice/piper1-gpl/blob/main/docs/API_PYTHON.md
-en_syn_config = SynthesisConfig()
-fa_syn_config = SynthesisConfig(length_scale=0.8)
+# ONNX inference is CPU bound and must not run on the event loop.
+executor = ThreadPoolExecutor(
+    max_workers=config.PIPER_THREADS, thread_name_prefix='piper'
+)
+
+
+class LoadedVoice:
+    def __init__(self, voice: PiperVoice, size: int):
+        self.voice = voice
+        # model file size, used as an estimate of its memory footprint
+        self.size = size
+        self.users = 0
+        self.last_used = monotonic()
+
+
+# Voices are loaded on first use and unloaded after PIPER_IDLE_UNLOAD seconds
+# without use, or earlier if loading another one would exceed
+# PIPER_MAX_MEMORY.
+loaded_voices: dict[str, LoadedVoice] = {}
+# model -> lock held while it is loaded, so that voices load concurrently
+_load_locks: dict[str, Lock] = {}
+_unload_task: Task | None = None
+
+
+def _voice_config(lang: str) -> tuple[str, float | None]:
+    return config.PIPER_VOICES.get(lang) or config.PIPER_VOICES['default']
+
+
+def voice_id(lang: str) -> str:
+    model, length_scale = _voice_config(lang)
+    return f'{model}:{length_scale}'
+
+
+def _unload(model: str):
+    loaded_voices.pop(model)
+    logger.info(f'Unloaded Piper voice {model}')
+
+
+def _make_room(size: int):
+    max_memory = config.PIPER_MAX_MEMORY
+    if not max_memory:
+        return
+    used = sum(v.size for v in loaded_voices.values())
+    for model, loaded in sorted(
+        loaded_voices.items(), key=lambda i: i[1].last_used
+    ):
+        if used + size <= max_memory:
+            return
+        if not loaded.users:
+            _unload(model)
+            used -= loaded.size
+    if used + size > max_memory:
+        logger.warning('PIPER_MAX_MEMORY exceeded by voices that are in use')
+
+
+async def _unload_idle_voices():
+    global _unload_task
+    idle_timeout = config.PIPER_IDLE_UNLOAD
+    while loaded_voices:
+        await sleep(idle_timeout / 4)
+        now = monotonic()
+        for model, loaded in [*loaded_voices.items()]:
+            if not loaded.users and now - loaded.last_used > idle_timeout:
+                _unload(model)
+    _unload_task = None
+
+
+@asynccontextmanager
+async def voice_for(lang: str) -> AsyncIterator[PiperVoice]:
+    global _unload_task
+    model, _ = _voice_config(lang)
+    async with _load_locks.setdefault(model, Lock()):
+        loaded = loaded_voices.get(model)
+        if loaded is None:
+            path = THIS_DIR / 'voices' / model
+            size = path.stat().st_size
+            _make_room(size)
+            logger.info(f'Loading Piper voice {model}')
+            voice = await to_thread(PiperVoice.load, path)
+            loaded = loaded_voices[model] = LoadedVoice(voice, size)
+            if config.PIPER_IDLE_UNLOAD and _unload_task is None:
+                _unload_task = create_task(_unload_idle_voices())
+        loaded.users += 1
+    try:
+        yield loaded.voice
+    finally:
+        loaded.users -= 1
+        loaded.last_used = monotonic()
 
 
 async def stream_audio_to_q(
-    audio_generator: Iterable[AudioChunk], audio_q: Queue
+    voice: PiperVoice,
+    text: str,
+    syn_config: SynthesisConfig,
+    audio_q: AudioSink,
 ):
     first_chunk = True
+    async with aclosing(
+        iterate_in_executor(
+            executor,
+            partial(voice.synthesize, text, syn_config),
+            config.PIPER_CHANNEL_SIZE,
+        )
+    ) as chunks:
+        async for chunk in chunks:
+            if first_chunk:
+                first_chunk = False
+                await audio_q.put(
+                    wav.header(
+                        chunk.sample_rate,
+                        chunk.sample_channels,
+                        chunk.sample_width,
+                    )
+                )
+            await audio_q.put(chunk.audio_int16_bytes)
+
 
-    for chunk in audio_generator:
-        if first_chunk:
-            # Create a mock WAV file in memory to get the header
-            mock_wav_file = BytesIO()
-            with wave.open(mock_wav_file, 'wb') as w:
-                w.setframerate(chunk.sample_rate)
-                w.setsampwidth(chunk.sample_width)
-                w.setnchannels(chunk.sample_channels)
-                # The wave library writes a header with a data chunk of size 0
-                # when you close the file without writing frames.
-                # It will automatically be updated with the actual size later.
-                w.close()
-
-            # Seek to the beginning and read the header bytes
-            mock_wav_file.seek(0)
-            wav_header = mock_wav_file.read()
-
-            # The header written by the wave library has a placeholder size.
-            # We need to send this placeholder first. The receiver should be
-            # designed to update the size or handle a stream of unknown size.
-            # For a true live stream, this is the best we can do.
-            await audio_q.put(wav_header)
-
-            first_chunk = False
-
-        # `await audio_q.put` does not yield control unless audio_q is full
-        await sleep(0)
-        await audio_q.put(chunk.audio_int16_bytes)
-
-    await audio_q.put(None)  # Sentinel for end of audio
-    # Note: If the receiving end needs the final size, it must be updated
-    # after the stream ends. For a live stream, this is often not possible
-    # and the receiving player must be tolerant of an empty or incorrect
-    # size field in the header.
-
-
-async def prefetch_audio(text: str, lang: str, audio_q: AudioQ):
-    is_fa = lang == 'fa'
-    voice, syn_config = (
-        (fa_voice, fa_syn_config) if is_fa else (en_voice, en_syn_config)
-    )
+async def prefetch_audio(text: str, lang: str, audio_q: AudioSink):
+    _, length_scale = _voice_config(lang)
     short_text = repr(text[:20] + '...')
-    await stream_audio_to_q(voice.synthesize(text, syn_config), audio_q)
+    async with voice_for(lang) as voice:
+        await stream_audio_to_q(
+            voice, text, SynthesisConfig(length_scale=length_scale), audio_q
+        )
     logger.debug(f'Audio cached for {short_text}')
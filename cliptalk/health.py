@@ -0,0 +1,153 @@
+"""
+Take failing engines out of service and bring them back once they recover.
+
+Every synthesis through a tracked fetcher is recorded; cache hits never
+reach it. After HEALTH_FAILURES consecutive failures (slow first chunks count
+as failures) the engine's circuit opens: texts, including the retries of
+ones in progress, are routed to its fallback engine and calls that still
+reach it fail at once instead of waiting for network timeouts. A
+background probe tries the engine again after a cool-down and closes the
+circuit when it succeeds.
+"""
+
+from asyncio import QueueShutDown, Task, create_task, sleep, timeout
+from time import monotonic
+
+from cliptalk import AudioQ, AudioSink, config, logger, warmup
+from cliptalk.cache import Fetcher
+from cliptalk.status import publisher
+
+
+class EngineUnavailable(Exception):
+    pass
+
+
+class EngineHealth:
+    def __init__(self, engine: str):
+        self.engine = engine
+        # closed (in service) or open (out of service)
+        self.state = 'closed'
+        self.failures = 0
+        self.cooldown = config.HEALTH_COOLDOWN
+        self.last_error = ''
+        # language of the last failed synthesis, used for probing
+        self.last_lang = 'default'
+        self._probe: Task | None = None
+        publisher.set_engine(engine, self.state)
+
+    @property
+    def available(self) -> bool:
+        return self.state == 'closed'
+
+    def succeeded(self):
+        self.failures = 0
+
+    def failed(self, lang: str, error: str):
+        self.failures += 1
+        self.last_lang = lang
+        self.last_error = error
+        if self.available and self.failures >= config.HEALTH_FAILURES:
+            self._set_state('open')
+            logger.warning(
+                f'Engine {self.engine} is out of service after '
+                f'{self.failures} failures ({error}); retrying in '
+                f'{self.cooldown}s'
+            )
+            self._probe = create_task(self._probe_until_recovered())
+
+    def _set_state(self, state: str):
+        self.state = state
+        publisher.set_engine(self.engine, state)
+
+    async def _probe_until_recovered(self):
+        texts = config.WARMUP_TEXTS
+        lang = self.last_lang
+        text = texts.get(lang) or texts.get('default') or 'Hello.'
+        while True:
+            await sleep(self.cooldown)
+            try:
+                fetcher = await warmup.load_raw_engine(self.engine)
+                async with timeout(config.HEALTH_SLOW_SECONDS):
+                    await fetcher(text, lang, AudioQ())
+            except Exception as e:
+                self.cooldown = min(
+                    self.cooldown * 2, config.HEALTH_MAX_COOLDOWN
+                )
+                logger.info(
+                    f'Probe of engine {self.engine} failed ({e!r}); '
+                    f'retrying in {self.cooldown}s'
+                )
+                continue
+            break
+        self.failures = 0
+        self.cooldown = config.HEALTH_COOLDOWN
+        self._set_state('closed')
+        logger.info(f'Engine {self.engine} is back in service')
+
+    def to_dict(self) -> dict:
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
+
+
+engines: dict[str, EngineHealth] = {}
+
+
+def get(engine: str) -> EngineHealth:
+    health = engines.get(engine)
+    if health is None:
+        health = engines[engine] = EngineHealth(engine)
+    return health
+
+
+def route(engine: str) -> str:
+    """Return `engine`, or its fallback while it is out of service."""
+    if get(engine).available:
+        return engine
+    fallback = config.FALLBACK_ENGINES.get(engine)
+    if fallback is None or not get(fallback).available:
+        return engine
+    return fallback
+
+
+class _TimingQ:
+    """Forward puts to an AudioSink, noting when the first chunk arrived."""
+
+    def __init__(self, audio_q: AudioSink):
+        self.audio_q = audio_q
+        self.first_chunk_time: float | None = None
+
+    async def put(self, data: bytes):
+        if self.first_chunk_time is None:
+            self.first_chunk_time = monotonic()
+        await self.audio_q.put(data)
+
+
+def tracked(engine: str, fetcher: Fetcher) -> Fetcher:
+    """Wrap `fetcher` so that its outcomes decide the engine's health."""
+    health = get(engine)
+
+    async def tracked_fetcher(text: str, lang: str, audio_q: AudioSink):
+        if not health.available:
+            raise EngineUnavailable(engine)
+        timing_q = _TimingQ(audio_q)
+        started = monotonic()
+        try:
+            await fetcher(text, lang, timing_q)
+        except QueueShutDown:
+            raise  # skipped, not the engine's fault
+        except Exception as e:
+            health.failed(lang, repr(e))
+            raise
+        first_chunk_time = timing_q.first_chunk_time
+        if (
+            first_chunk_time is not None
+            and first_chunk_time - started > config.HEALTH_SLOW_SECONDS
+        ):
+            health.failed(lang, 'slow first chunk')
+        else:
+            health.succeeded()
+
+    return tracked_fetcher
@@ -0,0 +1,104 @@
+"""
+Length-prefixed message channel between the Qt process and the server.
+
+The server listens on a loopback TCP port with asyncio streams, so messages
+are read on the event loop without a thread hop. Unix sockets would be the
+obvious choice elsewhere, but asyncio does not support them on Windows.
+Every frame is a 4-byte big-endian payload size, a 1-byte kind and the
+payload. Texts travel as raw UTF-8, nothing is pickled. The Qt process
+proves it was started by the server with a random token in its HELLO frame.
+"""
+
+import json
+import socket
+import struct
+from asyncio import StreamReader, StreamWriter
+
+HEADER = struct.Struct('!IB')
+
+# Qt -> server: token
+HELLO = 0
+# Qt -> server: JSON trace metadata, a newline and the UTF-8 text
+TEXT = 1
+# both ways: b'\1' for monitoring, b'\0' for paused
+MONITORING = 2
+# server -> Qt: JSON [min_space_ratio, min_text_length]
+SETTINGS = 3
+
+
+def frame(kind: int, payload: bytes) -> bytes:
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def text_payload(
+    trace_id: str, captured: float, sent: float, text: str
+) -> bytes:
+    meta = json.dumps({'trace': trace_id, 'captured': captured, 'sent': sent})
+    return f'{meta}\n{text}'.encode()
+
+
+def parse_text(payload: bytes) -> tuple[str, float, float, str]:
+    meta, _, text = payload.partition(b'\n')
+    m = json.loads(meta)
+    return m['trace'], m['captured'], m['sent'], text.decode()
+
+
+class FrameTooLarge(Exception):
+    def __init__(self, kind: int, size: int):
+        super().__init__(f'Payload of {size} bytes in a frame of kind {kind}')
+        self.kind = kind
+        self.size = size
+
+
+async def read_frame(reader: StreamReader, max_size: int) -> tuple[int, bytes]:
+    """
+    Raise IncompleteReadError once the other side has disconnected, and
+    FrameTooLarge, before reading it, for a payload over `max_size` bytes.
+    """
+    size, kind = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if size > max_size:
+        raise FrameTooLarge(kind, size)
+    return kind, await reader.readexactly(size)
+
+
+async def skip_payload(reader: StreamReader, size: int):
+    """Read past a payload that read_frame refused, without keeping it."""
+    while size:
+        size -= len(await reader.readexactly(min(size, 64 * 1024)))
+
+
+def write_frame(writer: StreamWriter, kind: int, payload: bytes):
+    writer.write(frame(kind, payload))
+
+
+class Connection:
+    """Blocking end of the channel, used by the Qt process."""
+
+    def __init__(self, port: int, token: bytes):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send(HELLO, token)
+
+    def send(self, kind: int, payload: bytes):
+        self.sock.sendall(frame(kind, payload))
+
+    def _recv_exactly(self, size: int) -> bytes:
+        buffer = bytearray()
+        while len(buffer) < size:
+            data = self.sock.recv(size - len(buffer))
+            if not data:
+                raise EOFError
+            buffer += data
+        return bytes(buffer)
+
+    def recv(self) -> tuple[int, bytes]:
+        size, kind = HEADER.unpack(self._recv_exactly(HEADER.size))
+        return kind, self._recv_exactly(size)
+
+    def close(self):
+        try:
+            # also wakes up a thread that is blocked in recv
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
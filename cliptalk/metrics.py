@@ -0,0 +1,185 @@
+"""
+Minimal Prometheus metrics, exported in the text format by /metrics.
+
+Recording a value is a dict lookup and an addition, so instrumentation can
+stay on under load. Values are kept per tuple of label values.
+"""
+
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import defaultdict
+
+# Seconds; synthesis of a long text may take a while.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace('\\', r'\\')
+        .replace('"', r'\"')
+        .replace('\n', r'\n')
+    )
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, **extra) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in pairs) + '}'
+
+
+class Metric(ABC):
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        registry.append(self)
+
+    @abstractmethod
+    def samples(self) -> list[str]: ...
+
+    def render(self) -> str:
+        return '\n'.join(
+            [
+                f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.type}',
+                *self.samples(),
+            ]
+        )
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self.values: defaultdict[tuple, float] = defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] += amount
+
+    def samples(self) -> list[str]:
+        return [
+            f'{self.name}{_format_labels(self.labels, k)} {v}'
+            for k, v in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, *labels):
+        self.values[labels] = value
+
+    def set_max(self, value: float, *labels):
+        values = self.values
+        if value > values[labels]:
+            values[labels] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        name = self.name
+        for k, counts in self.values.items():
+            cumulative = 0
+            for le, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                lines.append(
+                    f'{name}_bucket{_format_labels(self.labels, k, le=le)} '
+                    f'{cumulative}'
+                )
+            labels = _format_labels(self.labels, k)
+            lines.append(f'{name}_sum{labels} {counts[-1]}')
+            lines.append(f'{name}_count{labels} {cumulative}')
+        return lines
+
+
+registry: list[Metric] = []
+
+
+def render() -> str:
+    return '\n'.join(m.render() for m in registry) + '\n'
+
+
+time_to_first_chunk = Histogram(
+    'cliptalk_time_to_first_chunk_seconds',
+    'Time from the start of synthesis to the first audio chunk.',
+    ('engine', 'lang'),
+)
+synthesis_time = Histogram(
+    'cliptalk_synthesis_seconds',
+    'Total time to synthesize an item, including retries.',
+    ('engine', 'lang'),
+)
+retries = Counter(
+    'cliptalk_synthesis_retries_total',
+    'Failed synthesis attempts; each item gets up to three.',
+    ('engine', 'lang'),
+)
+failures = Counter(
+    'cliptalk_synthesis_failures_total',
+    'Items whose synthesis failed after all attempts.',
+    ('engine', 'lang'),
+)
+hedges = Counter(
+    'cliptalk_hedged_segments_total',
+    'Segments that were rendered by a fallback engine, too, by winner.',
+    ('lang', 'winner'),
+)
+engine_up = Gauge(
+    'cliptalk_engine_up',
+    '1 while an engine is in service, 0 while its circuit is open.',
+    ('engine',),
+)
+audio_bytes = Counter(
+    'cliptalk_audio_sent_bytes_total',
+    'Bytes of audio streamed by /audio.',
+)
+queue_depth = Gauge(
+    'cliptalk_queue_depth',
+    'Current number of items in a queue.',
+    ('queue',),
+)
+queue_peak = Gauge(
+    'cliptalk_queue_depth_peak',
+    'Highest number of items seen in a queue.',
+    ('queue',),
+)
+prefetch_ahead = Gauge(
+    'cliptalk_prefetch_ahead_seconds',
+    'Seconds of audio queued ahead of the next text to synthesize.',
+)
+real_time_factor = Gauge(
+    'cliptalk_real_time_factor',
+    'Moving average of synthesis seconds per second of audio.',
+    ('engine',),
+)
+audio_buffered_bytes = Gauge(
+    'cliptalk_audio_buffered_bytes',
+    'Bytes of audio held by all items, see AUDIO_BUDGET.',
+)
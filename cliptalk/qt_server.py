@@ -1,7 +1,7 @@
+import json
 import re
 from functools import partial
-from multiprocessing.connection import PipeConnection
-from time import time_ns
+from time import time, time_ns
 
 from PyQt6.QtCore import Qt, QThread, pyqtSignal
 from PyQt6.QtGui import QAction, QClipboard
@@ -13,7 +13,9 @@ from PyQt6.QtWidgets import (
     QSystemTrayIcon,
 )
 
-from cliptalk import logger
+from cliptalk import config, ipc, logger
+from cliptalk.dedup import RecentIndex, fingerprint
+from cliptalk.trace import new_id
 
 qt_app = QApplication([])
 # Ensure the application continues to run even if there are no visible windows,
@@ -26,6 +28,12 @@ rm_urls = partial(re.compile(r'[A-z]*:\/\/[^\s]*').sub, '')
 
 min_text_length: int
 min_space_ratio: float
+conn: ipc.Connection
+
+
+def apply_settings(payload: bytes):
+    global min_space_ratio, min_text_length
+    min_space_ratio, min_text_length = json.loads(payload)
 
 
 def skip(text: str):
@@ -42,17 +50,13 @@ def skip(text: str):
     return False
 
 
-previous_hash: int | None = None
+recent_texts = RecentIndex(config.DEDUP_HISTORY, config.DEDUP_WINDOW)
 
 
 def debounce_duplicate(text: str):
-    global previous_hash
-    new_hash = hash(text)
-    if new_hash == previous_hash:
-        logger.debug('Debouncing duplicate text.')
-        previous_hash = None
+    if recent_texts.seen(fingerprint(text)):
+        logger.debug('Debouncing recently copied text.')
         return True
-    previous_hash = new_hash
 
 
 prev_ms = 0
@@ -72,6 +76,8 @@ def on_clipboard_changed():
     Callback function triggered when clipboard content changes.
     Processes the text if monitoring is active and sends it via the pipe.
     """
+    trace_id = new_id()
+    captured = time()
     if debounce_too_fast():
         return
 
@@ -91,7 +97,7 @@ def on_clipboard_changed():
 
     logger.info(f'Received text: {text[:50]}...')  # Log a snippet for brevity
     # Send the processed text (URLs removed) through the pipe
-    conn.send(text)
+    conn.send(ipc.TEXT, ipc.text_payload(trace_id, captured, time(), text))
 
 
 # --- Functions for controlling monitoring state via tray icon and pipe ---
@@ -138,10 +144,10 @@ def handle_tray_click(
     Toggles the monitoring state (pause/resume) and updates the tray icon's menu actions.
     """
     if pause_action.isEnabled():
-        conn.send(False)
+        conn.send(ipc.MONITORING, b'\0')
         logger.info('Monitoring paused via tray icon.')
     else:
-        conn.send(True)
+        conn.send(ipc.MONITORING, b'\1')
         logger.info('Monitoring resumed via tray icon.')
 
     _toggle_tray_ui(tray_icon, pause_action, resume_action, style)
@@ -193,7 +199,7 @@ def show_about_message():
 
 class PipeReaderThread(QThread):
     """
-    A QThread subclass to read boolean messages from a multiprocessing PipeConnection
+    A QThread subclass to read monitoring messages from the server connection
     and emit them as a Qt signal.
     """
 
@@ -207,21 +213,21 @@ class PipeReaderThread(QThread):
         """
         Continuously reads from the pipe and emits data.
         """
-        global min_space_ratio, min_text_length
         logger.info('PipeReaderThread started.')
         while self._running:
             try:
-                msg = conn.recv()
-                if type(msg) is bool:
+                kind, payload = conn.recv()
+                if kind == ipc.MONITORING:
+                    msg = payload == b'\1'
                     logger.info(f'PipeReaderThread received message: {msg}')
                     self.data_received.emit(msg)
-                elif type(msg) is tuple:
-                    min_space_ratio, min_text_length = msg
+                elif kind == ipc.SETTINGS:
+                    apply_settings(payload)
                 else:
                     logger.warning(
-                        f'PipeReaderThread received non-boolean message from pipe: {msg}'
+                        f'PipeReaderThread received unexpected message kind: {kind}'
                     )
-            except EOFError:
+            except (EOFError, OSError):
                 logger.info('Pipe closed, PipeReaderThread exiting.')
                 self._running = False
             except Exception as e:
@@ -236,16 +242,21 @@ class PipeReaderThread(QThread):
         Stops the thread's run loop.
         """
         self._running = False
+        conn.close()  # unblocks recv
         self.wait()  # Wait for the thread to finish execution
 
 
-def run_qt_app(pipe: PipeConnection):
+def run_qt_app(port: int, token: bytes):
     """
     Initializes and runs the PyQt6 application, including the system tray icon
-    and a listener for control messages from the pipe.
+    and a listener for control messages from the server.
     """
     global conn
-    conn = pipe
+    conn = ipc.Connection(port, token)
+    # the server answers the handshake with the filter settings
+    kind, payload = conn.recv()
+    if kind == ipc.SETTINGS:
+        apply_settings(payload)
     # Create the system tray icon
     style = qt_app.style()
     assert style is not None
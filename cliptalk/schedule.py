@@ -0,0 +1,155 @@
+"""
+Pace synthesis to playback, in seconds of audio rather than items.
+
+For each engine, moving averages of its real-time factor (seconds of
+synthesis per second of audio), its first chunk latency and the seconds of
+audio per character are kept. Before a text is synthesized, the scheduler
+waits until the audio queued ahead of it would play for less than the lead
+the text needs: enough to cover the first chunk latency, or, for an engine
+slower than real time, the time it falls behind over the whole text.
+
+Listeners report their playback position, so the remaining time of the
+current item is known. Without reports, it counts in full.
+"""
+
+from asyncio import Event, timeout
+from contextlib import suppress
+from time import monotonic
+
+from cliptalk import AudioBuffer, config, wav
+
+# Bytes per second of Edge's audio-24khz-48kbitrate-mono-mp3.
+MP3_BYTE_RATE = 48_000 // 8
+# The front-end reports progress about once a second; without a report for
+# longer than this, the listener is assumed to have paused.
+REPORT_TIMEOUT = 2.0
+
+
+def audio_seconds(buffer: AudioBuffer) -> float:
+    chunks = buffer.chunks
+    if not chunks:
+        return 0.0
+    header_size = wav.header_size(chunks[0])
+    if header_size and (params := wav.params(chunks[0])) is not None:
+        sample_rate, channels, sample_width = params
+        return (buffer.size - header_size) / (
+            sample_rate * channels * sample_width
+        )
+    return buffer.size / MP3_BYTE_RATE
+
+
+def _average(old: float, new: float) -> float:
+    # slow to trust an engine that got faster (e.g. because of cache hits),
+    # quick to notice that it got slower
+    weight = 0.5 if new > old else 0.1
+    return old + weight * (new - old)
+
+
+class EngineRate:
+    def __init__(self):
+        self.real_time_factor = 0.5
+        self.first_chunk = 1.0
+        self.seconds_per_char = 1 / 15
+
+    def observe(
+        self, synthesis: float, first_chunk: float, audio: float, chars: int
+    ):
+        if audio <= 0 or chars <= 0:
+            return
+        self.real_time_factor = _average(
+            self.real_time_factor, synthesis / audio
+        )
+        self.first_chunk = _average(self.first_chunk, first_chunk)
+        self.seconds_per_char += 0.2 * (audio / chars - self.seconds_per_char)
+
+
+class Scheduler:
+    def __init__(self):
+        self.rates: dict[str, EngineRate] = {}
+        # audio of items that are being synthesized or played ->
+        # (engine, number of characters)
+        self.items: dict[AudioBuffer, tuple[str, int]] = {}
+        self.playing: AudioBuffer | None = None
+        # last reported position in `playing` and its monotonic time
+        self.position = 0.0
+        self.position_time = 0.0
+        self._changed = Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = Event()
+
+    def rate(self, engine: str) -> EngineRate:
+        rate = self.rates.get(engine)
+        if rate is None:
+            rate = self.rates[engine] = EngineRate()
+        return rate
+
+    def _duration(self, buffer: AudioBuffer, engine: str, chars: int):
+        seconds = audio_seconds(buffer)
+        if buffer.done:
+            return seconds
+        return max(seconds, chars * self.rate(engine).seconds_per_char)
+
+    def ahead(self) -> float:
+        """Seconds of queued audio that play before a new item."""
+        total = 0.0
+        items = self.items
+        for buffer, (engine, chars) in [*items.items()]:
+            if buffer.cancelled:
+                del items[buffer]
+                continue
+            seconds = self._duration(buffer, engine, chars)
+            if buffer is self.playing:
+                elapsed = min(monotonic() - self.position_time, REPORT_TIMEOUT)
+                seconds = max(seconds - self.position - elapsed, 0.0)
+            total += seconds
+        return total
+
+    def lead(self, engine: str, chars: int) -> float:
+        """Seconds of audio that should be queued ahead of a new item."""
+        rate = self.rate(engine)
+        duration = chars * rate.seconds_per_char
+        needed = max(rate.first_chunk, duration * (rate.real_time_factor - 1))
+        return needed * config.PREFETCH_SAFETY + config.PREFETCH_MARGIN
+
+    async def wait(self, engine: str, chars: int):
+        """Wait until synthesis of a new item should start."""
+        while (excess := self.ahead() - self.lead(engine, chars)) > 0:
+            # time passing is polled, reported changes wake up at once
+            with suppress(TimeoutError):
+                async with timeout(min(excess, 1.0)):
+                    await self._changed.wait()
+
+    def started(self, buffer: AudioBuffer, engine: str, chars: int):
+        self.items[buffer] = (engine, chars)
+
+    def synthesized(
+        self,
+        buffer: AudioBuffer,
+        engine: str,
+        chars: int,
+        synthesis: float,
+        first_chunk: float,
+    ):
+        self.rate(engine).observe(
+            synthesis, first_chunk, audio_seconds(buffer), chars
+        )
+        self._notify()
+
+    def progress(self, buffer: AudioBuffer, position: float):
+        if buffer not in self.items:
+            return
+        self.playing = buffer
+        self.position = position
+        self.position_time = monotonic()
+        self._notify()
+
+    def finished(self, buffer: AudioBuffer):
+        self.items.pop(buffer, None)
+        if self.playing is buffer:
+            self.playing = None
+        self._notify()
+
+
+scheduler = Scheduler()
@@ -0,0 +1,480 @@
+"""
+Split texts into sentence-sized segments and synthesize them as a pipeline.
+
+The first segment is kept short so that playback can start as soon as
+possible. Later segments are rendered ahead, concurrently, while earlier ones
+are being streamed. All segments are stitched into a single audio stream;
+for WAV engines only the first segment's header is kept.
+
+Texts that mix scripts are first split into runs, so that e.g. a Persian
+word in an English paragraph is read by the Persian voice. Runs may be
+rendered by different engines; segments whose audio format differs from the
+stream's are converted with ffmpeg. Without ffmpeg, items are routed to a
+single engine where one has voices for all of their languages, and segments
+that still differ are skipped.
+
+A Progress kept across retries records what already reached the stream, so
+that a retry continues where the failed attempt stopped: finished segments
+are skipped and the audio of the interrupted one that was already sent is
+dropped from its re-render. Edge renders differ from one attempt to the
+next, so its segments are resumed after the last word that was sent whole.
+"""
+
+from asyncio import (
+    FIRST_COMPLETED,
+    CancelledError,
+    Event,
+    Future,
+    QueueShutDown,
+    Task,
+    create_task,
+    gather,
+    get_running_loop,
+    wait,
+)
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from contextlib import asynccontextmanager
+from heapq import heappop, heappush
+from itertools import count
+from re import M, compile as rc
+
+from cliptalk import AudioQ, AudioSink, config, encode, logger, metrics, wav
+from cliptalk.cache import Fetcher
+from cliptalk.engines import word_boundaries
+from cliptalk.schedule import MP3_BYTE_RATE
+
+# (item, segment) of a render; lower values get engine slots first
+Priority = tuple[int, int]
+
+
+class EngineLimit:
+    """
+    Let up to `value` renders use an engine at the same time.
+
+    Unlike a Semaphore, a free slot goes to the waiting render with the
+    lowest priority rather than the one that waited longest, so that the
+    segments of the item that plays next do not queue behind the lookahead
+    of later items.
+    """
+
+    def __init__(self, value: int):
+        self.value = value
+        # (priority, arrival, future) of waiting renders
+        self._waiters: list[tuple[Priority, int, Future]] = []
+        self._arrivals = count()
+
+    async def acquire(self, priority: Priority):
+        if self.value > 0:
+            self.value -= 1
+            return
+        future = get_running_loop().create_future()
+        heappush(self._waiters, (priority, next(self._arrivals), future))
+        try:
+            await future
+        except CancelledError:
+            if not future.cancelled():  # the slot was handed over already
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            future = heappop(self._waiters)[2]
+            if not future.done():  # cancelled waiters are skipped
+                future.set_result(None)
+                return
+        self.value += 1
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority) -> AsyncIterator[None]:
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+# (fetcher, segment, lang, engine_limit)
+Part = tuple[Fetcher, str, str, EngineLimit]
+# (fallback fetcher, its engine_limit, seconds to wait for the first chunk)
+Hedge = tuple[Fetcher, EngineLimit, float]
+
+# Arabic-script letters, without the digits and punctuation of the block
+# (e.g. ۱۲۳ or ،)
+_fa_letters = '\u0620-\u064a\u066e-\u06d3\u06d5'
+# letters, with their diacritics and zero-width non-joiners
+_fa_runs = rc(f'[{_fa_letters}][{_fa_letters}\u064b-\u065f\u200c]*').finditer
+_letter = rc(r'[^\W\d_]')
+
+# A sentence ends with terminal punctuation followed by white space, or
+# at the end of a line.
+_sentences = rc(r'[^\n]+?(?:[.!?؟؛…]+["\'”’)\]]*(?=\s)|$)', M).finditer
+
+
+def sentences(text: str) -> Iterator[str]:
+    for match in _sentences(text):
+        if sentence := match.group().strip():
+            yield sentence
+
+
+def script_runs(text: str) -> list[tuple[str, str]]:
+    """
+    Split `text` into (lang, run) pairs of Arabic-script ('fa') and other
+    ('en') text, in a single pass.
+
+    Only letters start a run. Digits, punctuation and spaces, including
+    Persian ones, stay with the run before them.
+    """
+    # (start, lang) of each run
+    starts: list[tuple[int, str]] = []
+    pos = 0
+    for match in _fa_runs(text):
+        if (letter := _letter.search(text, pos, match.start())) is not None:
+            starts.append((letter.start() if starts else 0, 'en'))
+        if not starts or starts[-1][1] != 'fa':
+            starts.append((match.start() if starts else 0, 'fa'))
+        pos = match.end()
+    if (letter := _letter.search(text, pos)) is not None or not starts:
+        starts.append((letter.start() if starts else 0, 'en'))  # type: ignore
+    ends = [start for start, _ in starts[1:]] + [len(text)]
+    return [
+        (lang, text[start:end]) for (start, lang), end in zip(starts, ends)
+    ]
+
+
+def split_text(text: str) -> list[str]:
+    segments: list[str] = []
+    limit = config.SEGMENT_FIRST_MAX_CHARS
+    current = ''
+    for sentence in sentences(text):
+        while sentence:
+            if len(current) + len(sentence) < limit:
+                current = f'{current} {sentence}' if current else sentence
+                break
+            if current:
+                segments.append(current)
+                current = ''
+            elif len(sentence) <= limit:
+                current = sentence
+                break
+            else:  # a single sentence that does not fit; cut at a space
+                cut = sentence.rfind(' ', 0, limit)
+                if cut <= 0:
+                    cut = limit
+                segments.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            limit = config.SEGMENT_MAX_CHARS
+    if current:
+        segments.append(current)
+    return segments
+
+
+async def _render(
+    fetcher: Fetcher,
+    segment: str,
+    lang: str,
+    engine_limit: EngineLimit,
+    segment_q: AudioQ,
+    words: list[tuple[int, float]] | None = None,
+    acquired: Event | None = None,
+    priority: Priority = (0, 0),
+):
+    """Render with `fetcher`; `acquired` is set once it has a slot."""
+    word_boundaries.set(words)
+    try:
+        async with engine_limit.slot(priority):
+            if acquired is not None:
+                acquired.set()
+            await fetcher(segment, lang, segment_q)
+    finally:
+        segment_q.shutdown()
+
+
+async def _next_chunk(segment_q: AudioQ) -> bytes | None:
+    """Return the next non-empty chunk, or None once the segment is done."""
+    while True:
+        try:
+            chunk = await segment_q.get()
+        except QueueShutDown:
+            return None
+        if chunk:
+            return chunk
+
+
+async def _hedged_render(
+    part: Part,
+    hedge: Hedge,
+    segment_q: AudioQ,
+    words: list[tuple[int, float]],
+    priority: Priority,
+):
+    """
+    Render `part`, and if its first chunk takes longer than the deadline,
+    render it with the fallback engine, too. The first to produce a chunk is
+    streamed and the other one is cancelled.
+
+    The deadline starts once the primary has an engine slot, so that time
+    spent queueing for the engine does not start hedges. The word boundaries
+    of the streamed render are passed on to `words`.
+    """
+    fetcher, segment, lang, engine_limit = part
+    fallback, fallback_limit, deadline = hedge
+    qs: list[AudioQ] = []
+    renders: list[Task] = []
+    # task getting the first chunk of a render -> index of the render
+    firsts: dict[Task, int] = {}
+    # word boundaries of each render
+    render_words: list[list[tuple[int, float]]] = []
+    acquired = Event()
+
+    def start(f: Fetcher, limit: EngineLimit, acquired: Event | None = None):
+        qs.append(q := AudioQ())
+        render_words.append(w := [])
+        renders.append(
+            create_task(
+                _render(f, segment, lang, limit, q, w, acquired, priority)
+            )
+        )
+        firsts[create_task(_next_chunk(q))] = len(qs) - 1
+
+    start(fetcher, engine_limit, acquired)
+    winner = chunk = None
+    try:
+        await acquired.wait()
+        while winner is None and firsts:
+            done, _ = await wait(
+                firsts,
+                timeout=deadline if len(qs) == 1 else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for task in done:
+                i = firsts.pop(task)
+                if (chunk := task.result()) is not None:
+                    winner = i
+                    break
+            if len(qs) == 1 and winner is None:
+                # too slow, or failed without audio
+                start(fallback, fallback_limit)
+        if winner is None:
+            await renders[0]  # re-raise the primary's error
+            return
+        # free the other engine's slot at once
+        losers = [task for i, task in enumerate(renders) if i != winner]
+        for task in [*losers, *firsts]:
+            task.cancel()
+        if len(qs) > 1:
+            won = 'fallback' if winner else 'primary'
+            metrics.hedges.inc(lang, won)
+            logger.info(f'Hedged render won by the {won}: {segment[:20]}')
+        won_words = render_words[winner]
+        while chunk is not None:
+            # boundaries arrive before the audio that they belong to
+            words += won_words[len(words) :]
+            await segment_q.put(chunk)
+            chunk = await _next_chunk(qs[winner])
+        words += won_words[len(words) :]
+        await renders[winner]
+    finally:
+        segment_q.shutdown()
+        tasks = [*renders, *firsts]
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+
+
+# sample_width -> ffmpeg PCM codec
+_PCM_CODECS = {1: 'pcm_u8', 2: 'pcm_s16le', 3: 'pcm_s24le', 4: 'pcm_s32le'}
+
+
+def _conversion(
+    audio_format: tuple[int, int, int] | str,
+) -> tuple[list[str], str]:
+    """Return ffmpeg options and container to convert to `audio_format`."""
+    if audio_format == 'mp3':  # what Edge streams
+        return [
+            *encode.FORMATS['mp3'][1],
+            *('-ar', '24000', '-ac', '1'),
+            *('-id3v2_version', '0', '-write_xing', '0'),
+        ], 'mp3'
+    sample_rate, channels, sample_width = audio_format
+    return [
+        *('-ar', str(sample_rate), '-ac', str(channels)),
+        *('-c:a', _PCM_CODECS.get(sample_width, 'pcm_s16le')),
+        *('-map_metadata', '-1', '-fflags', '+bitexact'),
+    ], 'wav'
+
+
+class Progress:
+    """What of an item has reached its audio_q, across synthesis attempts."""
+
+    def __init__(self):
+        # number of parts whose audio was forwarded completely
+        self.done = 0
+        # the rest of the next part's text, once it was resumed after a word
+        self.text: str | None = None
+        # bytes of the next part's audio, without header, that were forwarded
+        self.sent = 0
+        # word boundaries of the next part's audio, see word_boundaries
+        self.words: list[tuple[int, float]] = []
+        # (sample_rate, channels, sample_width) of WAV streams, or 'mp3'
+        self.format: tuple[int, int, int] | str | None = None
+
+    def next_part(self):
+        self.done += 1
+        self.text = None
+        self.sent = 0
+        self.words = []
+
+    def restart_part(self, segment: str):
+        """
+        Render the next part again, after its last word that was forwarded
+        whole or else from its start (or its resumed text).
+        """
+        self.resume(segment)
+        self.sent = 0
+        self.words = []
+
+    def resume(self, segment: str) -> tuple[str, int]:
+        """
+        Return the text to render for the next part and the number of bytes
+        at the start of its audio that were already forwarded.
+        """
+        text = segment if self.text is None else self.text
+        if not self.sent or self.format != 'mp3':
+            return text, self.sent
+        sent_seconds = self.sent / MP3_BYTE_RATE
+        end = max(
+            (end for end, at in self.words if at <= sent_seconds), default=0
+        )
+        if not end or not (rest := text[end:].strip()):
+            return text, self.sent
+        self.text = rest
+        self.sent = 0
+        self.words = []
+        return rest, 0
+
+
+class _Stitcher:
+    """Move the audio of segments into one stream, in a single format."""
+
+    def __init__(self, audio_q: AudioSink, progress: Progress):
+        self.audio_q = audio_q
+        self.progress = progress
+
+    async def _put(self, data: bytes, skip: int) -> int:
+        """Forward `data` without its first `skip` bytes; return the rest."""
+        if skip:
+            skipped = min(skip, len(data))
+            data = data[skipped:]
+            skip -= skipped
+        if data:
+            await self.audio_q.put(data)
+            self.progress.sent += len(data)
+        return skip
+
+    async def forward(self, segment_q: AudioQ, part: Part, skip: int = 0):
+        """Forward a segment's audio, except `skip` bytes after its header."""
+        progress = self.progress
+        pending = b''
+        size = None
+        while size is None:
+            if (chunk := await _next_chunk(segment_q)) is None:
+                # too short to tell; pass it on as it is
+                if pending:
+                    await self.audio_q.put(pending)
+                return
+            pending += chunk
+            size = wav.header_size(pending)
+        audio_format = wav.params(pending[:size]) if size else 'mp3'
+        if progress.format is None:
+            progress.format = audio_format
+            if size:
+                # the first segment's size is not the size of the stream
+                await self.audio_q.put(
+                    wav.with_data_size(pending[:size], wav.UNKNOWN_SIZE)
+                )
+        elif audio_format != progress.format:
+            while (chunk := await _next_chunk(segment_q)) is not None:
+                pending += chunk
+            await self._convert(pending, part, skip)
+            return
+        skip = await self._put(pending[size:], skip)
+        while (chunk := await _next_chunk(segment_q)) is not None:
+            skip = await self._put(chunk, skip)
+
+    async def _convert(self, data: bytes, part: Part, skip: int):
+        options, container = _conversion(self.progress.format)  # type: ignore
+        converted = await encode.transcode(data, options, container)
+        if converted is not None:
+            if container == 'wav':
+                converted = converted[wav.header_size(converted) or 0 :]
+            await self._put(converted, skip)
+            return
+        # routing avoids this where an engine can read the whole item
+        logger.warning(f'Skipped a segment in another format: {part[1]!r}')
+
+
+def split_runs(runs: list[Part]) -> list[Part]:
+    """Split runs of text into segments that keep the run's engine."""
+    return [
+        (fetcher, segment, lang, engine_limit)
+        for fetcher, run, lang, engine_limit in runs
+        for segment in split_text(run) or [run]
+    ]
+
+
+async def synthesize(
+    parts: list[Part],
+    audio_q: AudioSink,
+    hedges: dict[str, Hedge],
+    progress: Progress,
+    wait_for_budget: Callable[[], Awaitable] | None = None,
+    order: int = 0,
+):
+    """
+    Synthesize `parts` segment by segment into `audio_q`, hedging the parts
+    whose lang is in `hedges`.
+
+    Pass the same `progress` to retries of a failed call to continue where
+    it stopped. `wait_for_budget` is awaited before each segment's render
+    is started. Items with a lower `order` get engine slots first; pass the
+    order in which they play.
+    """
+    stitcher = _Stitcher(audio_q, progress)
+    parts = parts[progress.done :]
+    fetcher, segment, lang, engine_limit = parts[0]
+    segment, skip = progress.resume(segment)
+    parts[0] = fetcher, segment, lang, engine_limit
+    segment_qs = [AudioQ() for _ in parts]
+    # word boundaries of each segment's audio, see Progress.words
+    words: list[list[tuple[int, float]]] = [[] for _ in parts]
+    tasks: list[Task] = []
+
+    async def render_ahead(end: int):
+        for i in range(len(tasks), min(end, len(parts))):
+            if wait_for_budget is not None:
+                await wait_for_budget()
+            part = parts[i]
+            hedge = hedges.get(part[2])
+            priority = order, i
+            tasks.append(
+                create_task(
+                    _render(*part, segment_qs[i], words[i], priority=priority)
+                    if hedge is None
+                    else _hedged_render(
+                        part, hedge, segment_qs[i], words[i], priority
+                    )
+                )
+            )
+
+    try:
+        for i, segment_q in enumerate(segment_qs):
+            await render_ahead(i + config.SEGMENT_LOOKAHEAD + 1)
+            progress.words = words[i]
+            await stitcher.forward(segment_q, parts[i], skip)
+            await tasks[i]  # re-raise synthesis errors
+            progress.next_part()
+            skip = 0
+    finally:
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
@@ -0,0 +1,72 @@
+"""
+Push queue sizes, synthesis progress and engine health to listeners.
+
+Queues only record their new size, which costs a dict assignment. A single
+task sends the latest values of everything that changed since the last push
+as one 'status' message, at most once per STATUS_INTERVAL, so a burst of
+clipboard texts costs one websocket write per interval instead of one per
+put. While items are being synthesized, their progress is pushed too.
+"""
+
+from asyncio import Event, sleep
+from collections.abc import Awaitable, Callable
+
+from cliptalk import AudioBuffer, config
+from cliptalk.schedule import audio_seconds
+
+
+class StatusPublisher:
+    def __init__(self):
+        # queue name -> 'size/maxsize'
+        self.queues: dict[str, str] = {}
+        # trace ID -> audio of items whose progress is reported
+        self.items: dict[str, AudioBuffer] = {}
+        # engine -> circuit state, see health
+        self.engines: dict[str, str] = {}
+        self._changed = Event()
+
+    def set_queue(self, name: str, value: str):
+        if self.queues.get(name) != value:
+            self.queues[name] = value
+            self._changed.set()
+
+    def set_engine(self, engine: str, state: str):
+        self.engines[engine] = state
+        self._changed.set()
+
+    def track(self, trace_id: str, buffer: AudioBuffer):
+        """Report the synthesis progress of `buffer` until it is done."""
+        self.items[trace_id] = buffer
+        self._changed.set()
+
+    def message(self) -> dict:
+        return {
+            'action': 'status',
+            'queues': dict(self.queues),
+            'engines': dict(self.engines),
+            'items': {
+                trace_id: {
+                    'seconds': round(audio_seconds(buffer), 1),
+                    'done': buffer.done,
+                }
+                for trace_id, buffer in self.items.items()
+            },
+        }
+
+    async def run(self, send_json: Callable[[dict], Awaitable]):
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            message = self.message()
+            # the final state of finished items is sent once
+            items = self.items
+            for trace_id, buffer in [*items.items()]:
+                if buffer.done:
+                    del items[trace_id]
+            if items:
+                self._changed.set()
+            await send_json(message)
+            await sleep(config.STATUS_INTERVAL)
+
+
+publisher = StatusPublisher()
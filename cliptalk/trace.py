@@ -0,0 +1,117 @@
+"""
+Per-item lifecycle traces, from clipboard capture to the end of playback.
+
+Each text gets an ID when the clipboard changes. Every stage it passes
+through records a wall-clock timestamp (time.time(), so that stamps taken in
+the Qt process are comparable), which lets latency be attributed to Qt
+debouncing, the pipe, the queues, the engine or the browser. Recent traces
+are served by /traces; finished ones are also appended to TRACE_FILE.
+
+Stages, in their usual order:
+    captured        clipboard change seen by Qt
+    sent            text passed the filters and was sent to the server
+    received        text received from the pipe
+    queued          text put into in_q (or collapsed, if an equal text was
+                    still waiting; see dedup)
+    dequeued        text taken from in_q by prefetch_audio_loop
+    output_queued   its audio buffer put into out_q
+    synthesis_started, first_chunk, synthesized (or failed)
+    announced       sent to listeners as 'new-text'
+    audio_requested, audio_first_byte
+    playing         reported by the first listener that starts playing
+    ended (or skipped)
+"""
+
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from time import time
+from uuid import uuid4
+
+from cliptalk import config, logger
+
+FINAL_STAGES = ('ended', 'skipped', 'collapsed')
+
+
+def new_id() -> str:
+    return uuid4().hex[:16]
+
+
+class Trace:
+    def __init__(self, id: str, text: str):
+        self.id = id
+        self.text = text[:50]
+        self.info: dict[str, str] = {}
+        self.stages: dict[str, float] = {}
+
+    @property
+    def done(self) -> bool:
+        return any(stage in self.stages for stage in FINAL_STAGES)
+
+    def to_dict(self) -> dict:
+        # stages may be recorded late, e.g. first_chunk
+        stages = dict(sorted(self.stages.items(), key=lambda i: i[1]))
+        times = [*stages.values()]
+        # milliseconds spent before reaching each stage
+        durations = {
+            stage: round((t - previous) * 1000, 1)
+            for (stage, t), previous in zip([*stages.items()][1:], times[:-1])
+        }
+        return {
+            'id': self.id,
+            'text': self.text,
+            **self.info,
+            'stages': stages,
+            'durations_ms': durations,
+            'total_ms': round((times[-1] - times[0]) * 1000, 1)
+            if times
+            else 0.0,
+        }
+
+
+traces: OrderedDict[str, Trace] = OrderedDict()
+# appends to TRACE_FILE in order, without blocking the event loop
+_writer = ThreadPoolExecutor(1, 'trace-writer')
+
+
+def start(trace_id: str, text: str, **stages: float):
+    """Begin a trace with stages that were recorded elsewhere."""
+    trace = traces[trace_id] = Trace(trace_id, text)
+    trace.stages.update(stages)
+    while len(traces) > config.TRACE_HISTORY:
+        traces.popitem(last=False)
+
+
+def mark(
+    trace_id: str | None, stage: str, at: float | None = None, **info: str
+):
+    """Record the first time (or `at`) that the trace reaches `stage`."""
+    trace = traces.get(trace_id)  # type: ignore
+    if trace is None or stage in trace.stages:
+        return
+    if stage in FINAL_STAGES and trace.done:
+        return
+    trace.stages[stage] = time() if at is None else at
+    trace.info.update(info)
+    if stage in FINAL_STAGES:
+        _write(trace)
+
+
+def _append(path: Path, line: str):
+    try:
+        with open(path, 'a', encoding='utf8') as f:
+            f.write(line)
+    except OSError as e:
+        logger.warning(f'Could not write trace to {path}: {e!r}')
+
+
+def _write(trace: Trace):
+    if (path := config.TRACE_FILE) is None:
+        return
+    line = json.dumps(trace.to_dict(), ensure_ascii=False) + '\n'
+    _writer.submit(_append, path, line)
+
+
+def recent() -> list[dict]:
+    return [trace.to_dict() for trace in reversed(traces.values())]
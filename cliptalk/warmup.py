@@ -0,0 +1,186 @@
+"""
+Load and warm up engines in the background once the server is running.
+
+Importing an engine can take seconds (SAPI enumerates voices over COM, Piper
+imports onnxruntime) and the first synthesis of a voice pays further cold
+start costs, like loading an ONNX model and its first inference, or the first
+Edge handshake. Instead of doing all that before the server binds, engines
+are imported in a thread and then synthesize WARMUP_TEXTS once per configured
+voice, while the server is already accepting connections. /ready reports the
+progress.
+
+With PROFILE_STARTUP set, startup is profiled until warm-up finishes and a
+report with the slowest calls is logged and saved for pstats. Engine import
+times are always reported; `python -X importtime` breaks them down further.
+"""
+
+from asyncio import Task, create_task, gather, to_thread
+from collections.abc import Callable
+from cProfile import Profile
+from io import StringIO
+from pstats import Stats
+from time import perf_counter
+
+from cliptalk import AudioQ, config, logger
+from cliptalk.cache import Fetcher, audio_cache
+from cliptalk.engines import import_engine
+
+
+class EngineStatus:
+    def __init__(self):
+        # pending, loading, loaded, warming, ready, degraded (loaded, but a
+        # warm-up synthesis failed) or failed
+        self.state = 'pending'
+        self.import_seconds: float | None = None
+        # lang -> seconds of the warm-up synthesis
+        self.warmup_seconds: dict[str, float] = {}
+        self.error: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            'state': self.state,
+            'import_seconds': self.import_seconds,
+            'warmup_seconds': self.warmup_seconds,
+            'error': self.error,
+        }
+
+
+statuses: dict[str, EngineStatus] = {}
+_imports: dict[str, Task] = {}
+
+started = perf_counter()
+# startup milestone -> seconds since this module was imported
+milestones: dict[str, float] = {}
+_profiles: list[Profile] = []
+
+
+def milestone(name: str):
+    milestones[name] = round(perf_counter() - started, 3)
+    logger.debug(f'startup: {name} after {milestones[name]}s')
+
+
+def start_profiling():
+    profile = Profile()
+    _profiles.append(profile)
+    profile.enable()
+
+
+def _report_profile():
+    profile = _profiles.pop()
+    profile.disable()
+    stats = Stats(profile, stream=(stream := StringIO()))
+    if (path := config.PROFILE_STARTUP) is not None:
+        stats.dump_stats(path)
+    stats.sort_stats('cumulative').print_stats(25)
+    logger.info(
+        f'Startup milestones: {milestones}\n'
+        f'Engines: { {n: s.to_dict() for n, s in statuses.items()} }\n'
+        f'{stream.getvalue()}'
+    )
+
+
+async def _import(engine: str):
+    status = statuses.setdefault(engine, EngineStatus())
+    status.state = 'loading'
+    t = perf_counter()
+    try:
+        functions = await to_thread(import_engine, engine)
+    except Exception as e:
+        status.state = 'failed'
+        status.error = repr(e)
+        raise
+    status.import_seconds = round(perf_counter() - t, 3)
+    status.state = 'loaded'
+    return functions
+
+
+def _get_engine(engine: str) -> Task:
+    """Return the (shared) task that imports `engine`."""
+    task = _imports.get(engine)
+    if task is None:
+        task = _imports[engine] = create_task(_import(engine))
+    return task
+
+
+async def load_engine(
+    engine: str, wrap: Callable[[str, Fetcher], Fetcher] | None = None
+) -> Fetcher:
+    """
+    Return the cached fetcher of `engine`, waiting for its import. `wrap`
+    wraps the engine's own fetcher, so it only sees cache misses.
+    """
+    prefetch_audio, voice_id = await _get_engine(engine)
+    if wrap is not None:
+        prefetch_audio = wrap(engine, prefetch_audio)
+    return audio_cache.cached(engine, prefetch_audio, voice_id)
+
+
+async def load_voice_id(engine: str) -> Callable[[str], str]:
+    """Return the voice_id function of `engine`, waiting for its import."""
+    _, voice_id = await _get_engine(engine)
+    return voice_id
+
+
+async def load_raw_engine(engine: str) -> Fetcher:
+    """Return the uncached fetcher of `engine`."""
+    prefetch_audio, _ = await _get_engine(engine)
+    return prefetch_audio
+
+
+async def _warm_up_engine(engine: str, langs: list[str]):
+    status = statuses.setdefault(engine, EngineStatus())
+    try:
+        # the raw fetcher, so that warm-up is never a cache hit
+        prefetch_audio, _ = await _get_engine(engine)
+    except Exception as e:
+        logger.error(f'Could not load engine {engine}: {e!r}')
+        return
+    status.state = 'warming'
+    texts = config.WARMUP_TEXTS
+    for lang in langs:
+        if (text := texts.get(lang) or texts.get('default')) is None:
+            continue
+        t = perf_counter()
+        try:
+            await prefetch_audio(text, lang, AudioQ())
+        except Exception as e:
+            # the engine is loaded; real texts get their own retries
+            logger.warning(f'Warm-up of {engine} ({lang}) failed: {e!r}')
+            status.error = repr(e)
+            continue
+        status.warmup_seconds[lang] = round(perf_counter() - t, 3)
+    status.state = 'ready' if status.error is None else 'degraded'
+
+
+async def warm_up():
+    """Import and warm up all engines of ENGINES and HEDGES concurrently."""
+    milestone('warm-up started')
+    langs_by_engine: dict[str, list[str]] = {}
+    for lang, engine in [
+        *config.ENGINES.items(),
+        *((lang, engine) for lang, (engine, _) in config.HEDGES.items()),
+    ]:
+        statuses.setdefault(engine, EngineStatus())
+        langs = langs_by_engine.setdefault(engine, [])
+        if lang not in langs:
+            langs.append(lang)
+    await gather(
+        *(
+            _warm_up_engine(engine, langs)
+            for engine, langs in langs_by_engine.items()
+        )
+    )
+    milestone('engines ready')
+    if _profiles:
+        _report_profile()
+
+
+def ready_report() -> dict:
+    return {
+        'ready': all(
+            (s := statuses.get(engine)) is not None and s.state == 'ready'
+            for engine in config.ENGINES.values()
+        ),
+        'engines': {name: s.to_dict() for name, s in statuses.items()},
+        'startup': milestones,
+    }
@@ -0,0 +1,83 @@
+"""Helpers for the RIFF/WAVE container that PCM engines stream."""
+
+import struct
+
+HEADER_SIZE = 44
+# Size field value for streams whose final length is not known yet.
+UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+def header(
+    sample_rate: int,
+    channels: int,
+    sample_width: int,
+    data_size: int = UNKNOWN_SIZE,
+) -> bytes:
+    """Create a 44-byte PCM WAV header."""
+    block_align = channels * sample_width
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF',
+        min(36 + data_size, UNKNOWN_SIZE),
+        b'WAVE',
+        b'fmt ',
+        16,  # Subchunk Size (16 for PCM)
+        1,  # Audio Format (1 = PCM)
+        channels,
+        sample_rate,
+        sample_rate * block_align,  # Byte Rate
+        block_align,
+        sample_width * 8,  # Bits Per Sample
+        b'data',
+        data_size,
+    )
+
+
+def header_size(data: bytes) -> int | None:
+    """
+    Return the offset of the first PCM byte in `data`.
+
+    Return 0 if `data` is not a WAV stream and None if more bytes are needed
+    to tell.
+    """
+    if len(data) < 12:
+        return 0 if not b'RIFF'.startswith(data[:4]) else None
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        return 0
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos : pos + 4]
+        chunk_size = int.from_bytes(data[pos + 4 : pos + 8], 'little')
+        if chunk_id == b'data':
+            return pos + 8
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return None
+
+
+def with_data_size(wav_header: bytes, data_size: int) -> bytes:
+    """Return `wav_header` with its RIFF and data sizes set."""
+    data_offset = len(wav_header)
+    return b''.join(
+        (
+            wav_header[:4],
+            min(data_offset - 8 + data_size, UNKNOWN_SIZE).to_bytes(
+                4, 'little'
+            ),
+            wav_header[8 : data_offset - 4],
+            min(data_size, UNKNOWN_SIZE).to_bytes(4, 'little'),
+        )
+    )
+
+
+def params(data: bytes) -> tuple[int, int, int] | None:
+    """Return (sample_rate, channels, sample_width) of a WAV header."""
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos : pos + 4]
+        chunk_size = int.from_bytes(data[pos + 4 : pos + 8], 'little')
+        if chunk_id == b'fmt ' and pos + 24 <= len(data):
+            channels, sample_rate = struct.unpack_from('<HI', data, pos + 10)
+            bits = int.from_bytes(data[pos + 22 : pos + 24], 'little')
+            return sample_rate, channels, bits // 8
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return None
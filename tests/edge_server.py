@@ -0,0 +1,135 @@
+"""
+A local stand-in for the Edge TTS websocket service.
+
+It speaks enough of the protocol for cliptalk.engines.edge: every SSML turn
+gets a WordBoundary for each word and a few binary audio messages. Opening a
+connection takes `handshake_delay` seconds, like the TLS and websocket
+handshakes with the real service.
+
+Run it and set EDGE_WSS_URL to the printed URL to compare requests on warm
+and new connections in the debug log:
+
+    python tests/edge_server.py
+"""
+
+import json
+from asyncio import BaseTransport, Event, run, wait_for
+from re import compile as rc
+
+from aiohttp import WSMsgType
+from aiohttp.web import (
+    Application,
+    AppRunner,
+    Request,
+    Response,
+    TCPSite,
+    WebSocketResponse,
+)
+
+_words = rc(r'\w+').finditer
+_tags = rc(r'<[^>]*>').sub
+
+# seconds of audio per word
+WORD_SECONDS = 0.3
+
+
+def _text_message(path: str, body: str) -> str:
+    return f'X-RequestId:stand-in\r\nPath:{path}\r\n\r\n{body}'
+
+
+def audio_chunk(i: int) -> bytes:
+    """The audio of the `i`th binary message of a turn."""
+    return b'MP3' + bytes([i])
+
+
+class EdgeServer:
+    def __init__(self, handshake_delay: float = 0.2, chunks: int = 3):
+        self.handshake_delay = handshake_delay
+        self.chunks = chunks
+        # number of websocket handshakes so far
+        self.connections = 0
+        self.transports: set[BaseTransport] = set()
+        self._stopped = Event()
+        self.runner: AppRunner | None = None
+        self.url = ''
+
+    async def _handle(self, request: Request) -> WebSocketResponse | Response:
+        self.connections += 1
+        try:
+            # handshakes that are still pending end when the server stops
+            await wait_for(self._stopped.wait(), self.handshake_delay)
+        except TimeoutError:
+            pass
+        else:
+            return Response(status=503)
+        ws = WebSocketResponse()
+        await ws.prepare(request)
+        transport = request.transport
+        assert transport is not None
+        self.transports.add(transport)
+        try:
+            async for message in ws:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                headers, _, body = message.data.partition('\r\n\r\n')
+                if 'Path:ssml' in headers:
+                    await self._turn(ws, _tags('', body))
+        finally:
+            self.transports.discard(transport)
+        return ws
+
+    async def _turn(self, ws: WebSocketResponse, text: str):
+        await ws.send_str(_text_message('turn.start', '{}'))
+        metadata = [
+            {
+                'Type': 'WordBoundary',
+                'Data': {
+                    # in 100ns ticks
+                    'Offset': round(i * WORD_SECONDS * 10_000_000),
+                    'Duration': round(WORD_SECONDS * 10_000_000),
+                    'text': {'Text': match.group()},
+                },
+            }
+            for i, match in enumerate(_words(text))
+        ]
+        await ws.send_str(
+            _text_message('audio.metadata', json.dumps({'Metadata': metadata}))
+        )
+        header = b'X-RequestId:stand-in\r\nPath:audio\r\n'
+        for i in range(self.chunks):
+            await ws.send_bytes(
+                len(header).to_bytes(2, 'big') + header + audio_chunk(i)
+            )
+        await ws.send_str(_text_message('turn.end', '{}'))
+
+    def drop_connections(self):
+        """Drop all connections, like the service does with idle ones."""
+        for transport in self.transports:
+            transport.close()
+
+    async def start(self, port: int = 0):
+        app = Application()
+        app.router.add_get('/edge', self._handle)
+        self.runner = runner = AppRunner(app)
+        await runner.setup()
+        await TCPSite(runner, '127.0.0.1', port).start()
+        port = runner.addresses[0][1]
+        # the pool appends its query parameters with &
+        self.url = f'ws://127.0.0.1:{port}/edge?TrustedClientToken=stand-in'
+
+    async def stop(self):
+        if self.runner is not None:
+            self._stopped.set()
+            self.drop_connections()
+            await self.runner.cleanup()
+
+
+async def main():
+    server = EdgeServer()
+    await server.start(8765)
+    print(f'EDGE_WSS_URL = {server.url!r}')
+    await Event().wait()
+
+
+if __name__ == '__main__':
+    run(main())
@@ -0,0 +1,116 @@
+from asyncio import run, sleep
+from time import perf_counter
+
+import pytest
+from edge_server import EdgeServer, audio_chunk
+
+from cliptalk.engines import edge, word_boundaries
+
+HANDSHAKE_DELAY = 0.2
+AUDIO = b''.join(audio_chunk(i) for i in range(3))
+
+pytestmark = pytest.mark.skipif(
+    not edge.pooling, reason='edge_tts internals are missing'
+)
+
+
+class _Recorder:
+    """An AudioSink that keeps the audio and the time of its first byte."""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.first_byte: float | None = None
+
+    async def put(self, data: bytes):
+        if self.first_byte is None:
+            self.first_byte = perf_counter()
+        self.chunks.append(data)
+
+
+async def _request(text: str) -> tuple[bytes, float]:
+    """Synthesize `text`; return its audio and seconds to the first byte."""
+    recorder = _Recorder()
+    started = perf_counter()
+    await edge.prefetch_audio(text, 'en', recorder)
+    assert recorder.first_byte is not None
+    return b''.join(recorder.chunks), recorder.first_byte - started
+
+
+async def _until_warm():
+    while len(edge.pool.idle) < edge.pool.size:
+        await sleep(0.01)
+
+
+def _run_with_server(monkeypatch: pytest.MonkeyPatch, test):
+    """Run `test(server)` with the Edge engine pointed at a stand-in."""
+    monkeypatch.setattr(edge.config, 'EDGE_WARM_CONNECTIONS', 2)
+
+    async def main():
+        server = EdgeServer(HANDSHAKE_DELAY)
+        await server.start()
+        monkeypatch.setattr(
+            edge, 'pool', edge.ConnectionPool(server.url, 2, 30.0)
+        )
+        try:
+            await test(server)
+        finally:
+            await edge.pool.close()
+            await server.stop()
+
+    run(main())
+
+
+def test_warm_connection_skips_the_handshake(monkeypatch):
+    async def test(server: EdgeServer):
+        audio, cold = await _request('Hello world.')
+        assert audio == AUDIO
+        assert cold >= HANDSHAKE_DELAY
+        await _until_warm()
+        connections = server.connections
+        words: list[tuple[int, float]] = []
+        word_boundaries.set(words)
+        audio, warm = await _request('Hello again world.')
+        assert warm < HANDSHAKE_DELAY / 4
+        assert server.connections == connections
+        assert audio == AUDIO
+        assert words == [(5, 0.3), (11, 0.6), (17, 0.9)]
+
+    _run_with_server(monkeypatch, test)
+
+
+def test_dropped_warm_connection_is_replaced(monkeypatch):
+    async def test(server: EdgeServer):
+        edge.pool.fill()
+        await _until_warm()
+        connections = server.connections
+        server.drop_connections()
+        audio, _ = await _request('Hello world.')
+        assert audio == AUDIO
+        assert server.connections > connections
+
+    _run_with_server(monkeypatch, test)
+
+
+def test_close(monkeypatch):
+    async def test(server: EdgeServer):
+        await _request('Hello world.')
+        await _until_warm()
+        await edge.pool.close()
+        assert not edge.pool.idle
+        assert edge.pool._session is not None
+        assert edge.pool._session.closed
+
+    _run_with_server(monkeypatch, test)
+
+
+def test_unanswered_handshake_times_out(monkeypatch):
+    monkeypatch.setattr(edge, 'CONNECT_TIMEOUT', 0.2)
+
+    async def test(server: EdgeServer):
+        server.handshake_delay = 60  # accepts TCP, never upgrades
+        started = perf_counter()
+        with pytest.raises(TimeoutError):
+            await _request('Hello world.')
+        assert perf_counter() - started < 1
+
+    _run_with_server(monkeypatch, test)